@@ -21,11 +21,18 @@
 
 
 import os
-from collections import defaultdict, Counter
+from array import array
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import hashlib
+from itertools import accumulate, chain
 import json
+import threading
+import time
 
-import nltk
-import pandas as pd
+# numpy, pandas and scipy are slow to import so are
+# imported where they are used (see _sparse)
 
 from . import extract
 from . import utils
@@ -36,6 +43,15 @@ from . import tokenize
 ##reload(utils)
 ##reload(tokenize)
 
+def _sparse():
+    # Returns scipy.sparse, or None if scipy is not installed
+    # (scipy is optional, used for sparse output).
+    try:
+        from scipy import sparse
+    except ImportError:
+        return None
+    return sparse
+
 def _eval_indices(indices):
     # "indices" is a list of lists of integers (indices).
     # returns True if it is possible to choose an index from
@@ -58,35 +74,95 @@ def _eval_indices(indices):
     return True
 
 def _eval_indices2(indices):
-    # "indices" is a list of lists of integers (indices).
+    # "indices" is a list of sorted lists of integers (indices)
+    # (as returned by rule_indices).
     # returns the number of ways it is possible to choose an index from
     # each of the lists in turn s.t. the selected indices are
     # in increasing order.
+    # For each list in turn, the count for each of its indices is the
+    # sum of the counts for the indices of the previous list before it,
+    # accumulated while advancing a bound along the previous list (as
+    # _eval_indices_window with no window), so the cost is linear in
+    # the number of indices.
+    if not indices:
+        return 1
+    last_indices = indices[0]
+    counts = [1]*len(last_indices)
+    for inds in indices[1:]:
+        n = len(last_indices)
+        total = hi = 0
+        new_counts = []
+        for ind in inds:
+            while hi < n and last_indices[hi] < ind:
+                total += counts[hi]
+                hi += 1
+            new_counts.append(total)
+        last_indices, counts = inds, new_counts
+    return sum(counts)
+
+def _eval_indices2_batch(batch):
+    # "batch" is a list of "indices" (see _eval_indices2), each
+    # containing the same number of lists (e.g. the lists for
+    # a single rule for many texts).
+    # Returns a NumPy array of the counts returned by
+    # _eval_indices2 for each item in batch.
+    # Counts are computed for all items at once, one list
+    # position at a time, by offsetting the indices of
+    # each item so that they are disjoint and increasing.
+    # Counts must fit in int64.
+    import numpy as np
+    res = np.zeros(len(batch), dtype=np.int64)
+    if not batch or not batch[0]:
+        return res
+    stride = 1 + max((ind for indices in batch for lis in indices for ind in lis),
+                     default=0)
+    items = np.arange(len(batch), dtype=np.int64)
+    def level(k):
+        # offset indices (sorted) and the items they come from
+        lens = [len(indices[k]) for indices in batch]
+        inds = np.fromiter(chain.from_iterable(indices[k] for indices in batch),
+                           dtype=np.int64, count=sum(lens))
+        owners = np.repeat(items, lens)
+        offset = owners*stride + inds
+        order = np.argsort(offset, kind='stable')
+        return offset[order], owners[order]
+    last_offset, owners = level(0)
+    counts = np.ones(len(last_offset), dtype=np.int64)
+    for k in range(1, len(batch[0])):
+        offset, owners = level(k)
+        cum = np.concatenate([[0], np.cumsum(counts)])
+        # counts for the earlier indices of the same item
+        hi = np.searchsorted(last_offset, offset, side='left')
+        lo = np.searchsorted(last_offset, owners*stride, side='left')
+        counts = cum[hi] - cum[lo]
+        last_offset = offset
+    np.add.at(res, owners, counts)
+    return res
+
+def _eval_indices_window(indices, window):
+    # As _eval_indices2, but only counts the selections in which
+    # each index is at most "window" greater than the previous one.
+    # For each list in turn, the count for each of its indices is the
+    # sum of the counts for the indices of the previous list in
+    # [index - window, index), found by sliding the bounds of that
+    # range along the previous list, so the cost is linear in the
+    # number of indices (once sorted).
     indices = [sorted(lis) for lis in indices]
-    # go through process of constructing tree
-    # but just record leaf nodes and frequencies
-    # (numpaths) at each level
-    last_indices = indices[-1]
-    last_degrees = [1]*len(indices[-1])
-    for inds in reversed(indices[:-1]):
-        #print ('called', inds, last_indices)
-        nodes, degrees = _f(inds, last_indices)
-        if not nodes:
-            break
-        #print (nodes, degrees)
-        #print ('ld', last_degrees)
-        last_degrees = last_degrees[-degrees[0]:]
-        #print ('ld', last_degrees)
-        # accumulate last_degrees in reverse
-        for i in range(-2, -len(last_degrees)-1, -1):
-            last_degrees[i] += last_degrees[i+1]
-        #print ('ld', last_degrees)
-        last_degrees = [last_degrees[len(last_degrees) - degree] for degree in degrees]
-        #print ('ld', last_degrees)
-        last_indices = nodes
-    else:
-        return sum(last_degrees)
-    return 0
+    last_indices = indices[0]
+    counts = [1]*len(last_indices)
+    for inds in indices[1:]:
+        cum = [0]
+        cum.extend(accumulate(counts))
+        lo = hi = 0
+        new_counts = []
+        for ind in inds:
+            while hi < len(last_indices) and last_indices[hi] < ind:
+                hi += 1
+            while lo < hi and last_indices[lo] < ind - window:
+                lo += 1
+            new_counts.append(cum[hi] - cum[lo])
+        last_indices, counts = inds, new_counts
+    return sum(counts)
 
 def _eval_indices2_(indices):
     # brute force approach for testing purposes
@@ -100,179 +176,611 @@ def _eval_indices2_(indices):
             cnt += 1
     return cnt
 
-def _f(lis1, lis2):
-    # lis1 and lis2 are sorted lists of
-    # objects that support comparison
-    # returns the nodes (with non-zero outdegree)
-    # and the degrees of
-    # the bipartite graph with an edge from
-    # each node, v, in lis1 to each node, w,
-    # in lis2 s.t. v < w
-    it1 = iter(lis1)
-    it2 = enumerate(lis2)
-    nodes = []
-    degrees = []
-    v = next(it1)
-    j, w = next(it2)
-    try:
-        while True:
-            if v < w:
-                nodes.append(v)
-                degrees.append(len(lis2) - j)
-                v = next(it1)
-            else:
-                j, w = next(it2)
-    except StopIteration:
-        pass
-    return nodes, degrees
+def _eval_indices_window_(indices, window):
+    # brute force approach for testing purposes
+    from itertools import product
+    cnt = 0
+    for tup in product(*indices):
+        if all(0 < w - v <= window for v, w in zip(tup, tup[1:])):
+            cnt += 1
+    return cnt
 
 def _test_eval_indices2():
     import random
     for _ in range(100):
-        data = [random.choices(range(30), k=6),
-                random.choices(range(40), k=6),
-                random.choices(range(50), k=6),
-                random.choices(range(60), k=6),
-                random.choices(range(70), k=6),
-                random.choices(range(80), k=6)]
+        data = [sorted(random.choices(range(30), k=6)),
+                sorted(random.choices(range(40), k=6)),
+                sorted(random.choices(range(50), k=6)),
+                sorted(random.choices(range(60), k=6)),
+                sorted(random.choices(range(70), k=6)),
+                sorted(random.choices(range(80), k=6))]
         if not _eval_indices2(data) == _eval_indices2_(data):
             print ('Fail')
+    batch = [[random.choices(range(40), k=random.randint(0, 8)) for _ in range(4)]
+             for _ in range(100)]
+    if not list(_eval_indices2_batch(batch)) == [_eval_indices2_(data) for data in batch]:
+        print ('Fail (batch)')
+    for data in batch:
+        for window in (1, 3, 10):
+            if not _eval_indices_window(data, window) == _eval_indices_window_(data, window):
+                print ('Fail (window)')
+
+def compile_rules(rules):
+    # "rules" is a mapping of keys to lists of sets of keywords
+    # (as stored by BoolAnalyzer).
+    # Returns an inverted index mapping each keyword to a list of
+    # (key, i) pairs s.t. the keyword is in the i-th set of
+    # the rule with that key.
+    index = defaultdict(list)
+    for key, rule in rules.items():
+        for i, word_set in enumerate(rule):
+            for word in word_set:
+                index[word].append((key, i))
+    return dict(index)
+
+def collect_positions(words, index):
+    # Scans words (a list of words) once and returns a dict
+    # mapping each keyword (i.e. key of index) in words to the
+    # (sorted) list of its indices in words.
+    positions = {}
+    for j, word in enumerate(words):
+        if word in index:
+            try:
+                positions[word].append(j)
+            except KeyError:
+                positions[word] = [j]
+    return positions
+
+def collect_id_positions(ids, is_keyword):
+    # As collect_positions for a sequence of word ids supporting
+    # the buffer protocol (e.g. array('i')), where is_keyword is a
+    # boolean array indexed by id with a final False entry
+    # (for ids not known when it was constructed).
+    # Only the keyword positions are visited in Python.
+    import numpy as np
+    ids = np.asarray(ids)
+    inds = np.flatnonzero(is_keyword[np.minimum(ids, len(is_keyword) - 1)])
+    positions = {}
+    for j, word in zip(inds.tolist(), ids[inds].tolist()):
+        try:
+            positions[word].append(j)
+        except KeyError:
+            positions[word] = [j]
+    return positions
+
+def clause_masks(positions, index):
+    # Returns a dict mapping the keys of rules with at least
+    # one keyword in positions to a bitset (int) with the i-th
+    # bit set if a keyword from the i-th set is present.
+    # A rule can only fire if all its bits are set, so this is
+    # a cheap prefilter before any positional work.
+    masks = defaultdict(int)
+    for word in positions:
+        for key, i in index[word]:
+            masks[key] |= 1 << i
+    return masks
+
+def rule_indices(rule, positions):
+    # Returns the list of lists of indices that check_rule
+    # (or check_freq) would construct for rule.
+    # "positions" is the return value of collect_positions.
+    indices = []
+    for word_set in rule:
+        lists = [positions[word] for word in word_set.intersection(positions)]
+        if len(lists) == 1:
+            indices.append(lists[0])
+        else:
+            indices.append(sorted(chain.from_iterable(lists)))
+    return indices
 
-def check_rule(words, rule):
+def _ordered_bounds(indices):
+    # "indices" is a list of sorted, non-empty lists of indices.
+    # Returns False if no increasing selection is possible
+    # because the earliest index of the first list is not
+    # before the latest index of the last list.
+    return len(indices) < 2 or indices[0][0] < indices[-1][-1]
+
+def check_rule(words, rule, window=None):
     # words is a list of words from a section / paragraph / sentence
     # each word must be separated from punctuation characters e.g. ['dog', '.']
     # rule is a list of sets of keywords
     # be careful with case (e.g. lower case all words)
+    # If window is not None each selected keyword must be at
+    # most window words after the previous one.
+    # reject rules with a set of keywords absent from
+    # words before any positional work
+    vocab = set(words)
+    if any(word_set.isdisjoint(vocab) for word_set in rule):
+        return False
     indices = [[] for _ in rule]
     for i, word_set in enumerate(rule):
         for j, word in enumerate(words):
             if word in word_set:
                 indices[i].append(j)
-        if not indices[i]:
-            return False
+    if not _ordered_bounds(indices):
+        return False
+    if window is not None:
+        return _eval_indices_window(indices, window) > 0
     return _eval_indices(indices)
 
-def check_freq(words, rule):
+def check_freq(words, rule, window=None):
+    vocab = set(words)
+    if any(word_set.isdisjoint(vocab) for word_set in rule):
+        return 0
     indices = [[] for _ in rule]
     for i, word_set in enumerate(rule):
         for j, word in enumerate(words):
             if word in word_set:
                 indices[i].append(j)
-        if not indices[i]:
-            return 0
+    if not _ordered_bounds(indices):
+        return 0
+    if window is not None:
+        return _eval_indices_window(indices, window)
     return _eval_indices2(indices)
 
-def get_sentence_texts(filename):
+# the loaded synonym and hyponym maps and the
+# replacement stage constructed from them
+_normalisation = [None, None, None]
+
+def normalisation_stage(strict=False):
+    # Returns a pipeline stage that replaces synonyms then hyponyms
+    # (from synonyms.dat and hyponyms.dat, including phrases) in
+    # a single pass (see utils.phrase_replacement_factory).
+    # The stage is only reconstructed when either file changes.
+    # If strict is True a ValueError is raised if either map
+    # contains a cycle, or if a hyponym entry is never used
+    # because its key is replaced by a synonym (see compose_maps).
+    synonyms = utils.load_json_data('synonyms.dat')
+    hyponyms = utils.load_json_data('hyponyms.dat')
+    if strict:
+        utils.compose_maps(synonyms, hyponyms, resolve=True, strict=True)
+    if not (_normalisation[0] is synonyms and _normalisation[1] is hyponyms):
+        stage = utils.phrase_replacement_factory(synonyms, hyponyms)
+        _normalisation[:] = [synonyms, hyponyms, stage]
+    return _normalisation[2]
+
+def _lower(chunks):
+    return (chunk.lower() for chunk in chunks)
+
+def iter_sentence_texts(filename, stream=False):
     # A convenience function that illustrates
     # how to construct a pipeline and use it
     # to generate sentence texts
-    # Returns a list
+    # Returns a generator
+    # If stream is True the text is extracted and processed
+    # page by page (see extract.iter_pages), so memory use
+    # does not depend on the size of the document.
+    if stream:
+        pipeline = utils.Pipeline([_lower, tokenize.iter_sentences, tokenize.word_tokenize])
+        pipeline.append(normalisation_stage())
+        return pipeline(extract.iter_pages(filename))
     # get raw text
     text = extract.process(filename).decode().lower()
     # construct pipeline
-    pipeline = utils.Pipeline([nltk.sent_tokenize, tokenize.word_tokenize])
-    filter1 = utils.replacement_factory(utils.read_json_data('synonyms.dat'))
-    filter2 = utils.replacement_factory(utils.read_json_data('hyponyms.dat'))
-    pipeline.extend([filter1, filter2])
-    # process raw data and return
-    # list of texts
-    return list(pipeline(text))
-
-def get_paragraph_texts(filename):
+    pipeline = utils.Pipeline([tokenize.sent_tokenize, tokenize.word_tokenize])
+    pipeline.append(normalisation_stage())
+    # process raw data
+    return pipeline(text)
+
+def get_sentence_texts(filename, stream=False):
+    # As iter_sentence_texts, but returns a list
+    return list(iter_sentence_texts(filename, stream))
+
+def iter_paragraph_texts(filename, stream=False):
     # A convenience function that illustrates
     # how to construct a pipeline and use it
     # to generate paragraph texts
-    # Returns a list
+    # Returns a generator
+    # See iter_sentence_texts for stream.
+    if stream:
+        pipeline = utils.Pipeline([_lower, tokenize.iter_paragraphs, tokenize.word_tokenize])
+        pipeline.append(normalisation_stage())
+        return pipeline(extract.iter_pages(filename))
     # get raw text
     text = extract.process(filename).decode().lower()
     # construct pipeline
     pipeline = utils.Pipeline([tokenize.paragraph_tokenize, tokenize.word_tokenize])
-    filter1 = utils.replacement_factory(utils.read_json_data('synonyms.dat'))
-    filter2 = utils.replacement_factory(utils.read_json_data('hyponyms.dat'))
-    pipeline.extend([filter1, filter2])
-    # process raw data and return
-    # list of texts
-    return list(pipeline(text))
+    pipeline.append(normalisation_stage())
+    # process raw data
+    return pipeline(text)
+
+def get_paragraph_texts(filename, stream=False):
+    # As iter_paragraph_texts, but returns a list
+    return list(iter_paragraph_texts(filename, stream))
+
+
+# analyzer used by each worker process when
+# analyzing texts in parallel
+_worker_analyzer = None
+
+def _init_worker(analyzer):
+    # called once in each worker process so that
+    # the compiled rules are only sent once per process
+    global _worker_analyzer
+    _worker_analyzer = analyzer
+
+def _picklable(text):
+    # memoryviews (e.g. texts of a corpus.Corpus) cannot be
+    # sent to worker processes, so are copied to arrays
+    if isinstance(text, memoryview):
+        return array(text.format, text.tobytes())
+    return text
+
+def _analyze_chunk(chunk):
+    # "chunk" is a pair containing the index of the first
+    # text in the chunk and a list of texts.
+    # Returns a partial result (dict) of the kind
+    # stored by Analyzer.analyze.
+    start, texts = chunk
+    res = defaultdict(list)
+    for i, text in enumerate(texts, start):
+        for key, score in _worker_analyzer.score(text).items():
+            res[key].append((i, score))
+    return res
+
+def _analyze_batch_chunk(chunk):
+    # As _analyze_chunk using the batch analysis
+    # of a HybridAnalyzer.
+    start, texts = chunk
+    return _worker_analyzer._batch_results(texts, _sparse(), start)
+
+
+class RuleStats:
+    # statistics recorded for a rule by a profiled analyzer
+    def __init__(self):
+        self.evaluations = 0
+        self.hits = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return 'RuleStats(evaluations={}, hits={}, seconds={:.6f})'.format(
+            self.evaluations, self.hits, self.seconds)
+
+
+class ScoreMemo:
+    # Bounded LRU memo of the scores of texts, keyed on a hash
+    # of the analyzer's rules and a hash of the text, so a memo
+    # may be shared between analyses and analyzers (see
+    # BoolAnalyzer.memoize). Texts that are repeated word for
+    # word (e.g. boilerplate clauses) are only scored once.
+    def __init__(self, maxsize=2**16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scores)
+
+    def get(self, key):
+        # Returns the scores stored for key (or None).
+        with self._lock:
+            scores = self._scores.get(key)
+            if scores is None:
+                self.misses += 1
+                return None
+            self._scores.move_to_end(key)
+            self.hits += 1
+            return scores
+
+    def put(self, key, scores):
+        with self._lock:
+            self._scores[key] = scores
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.maxsize:
+                self._scores.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._scores.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'size': len(self), 'maxsize': self.maxsize}
+
+    def __repr__(self):
+        return 'ScoreMemo(maxsize={}, size={}, hits={}, misses={})'.format(
+            self.maxsize, len(self), self.hits, self.misses)
 
 
 class Analyzer:
     def __init__(self, rules):
         # if rules is a filepath load
         # rules (assumed to be in json format)
+        # The loaded rules are cached and shared
+        # between analyzers, so must not be modified.
         if isinstance(rules, (str, bytes, os.PathLike)):
-            self.rules = utils.read_json_data(rules)
+            self.rules = utils.load_json_data(rules)
         else:
             self.rules = rules
 
     def analyze(self, texts):
         raise NotImplementedError
 
+    def analyze_iter(self, texts):
+        raise NotImplementedError
+
 
 class BoolAnalyzer(Analyzer):
     def __init__(self, rules):
         Analyzer.__init__(self, rules)
         # for efficiency remove longer descriptions and
-        # convert lists to sets
-        for key, lis in list(self.rules.items()):
+        # convert lists to sets (in a new dict, as the
+        # rules passed in may be shared)
+        # A rule may end with a dict of options. Currently the only
+        # option is "window", the maximum number of words between
+        # consecutive keywords (e.g. {"window": 10}).
+        rules = self.rules
+        self.rules = {}
+        self.windows = {}
+        for key, lis in rules.items():
+            options = {}
+            if lis and isinstance(lis[-1], dict):
+                lis, options = lis[:-1], lis[-1]
             self.rules[key] = [set(item) for item in lis[1:]]
+            if options.get('window') is not None:
+                self.windows[key] = options['window']
+        self.vocab = None
+        self.memo = None
+        self.compile()
         self.texts = None
         self.results = None
 
-    def analyze(self, texts):
+    def compile(self):
+        # (Re)construct the data derived from the rules.
+        # map each keyword to the rules (and sets) that use it
+        # so that each text need only be scanned once
+        self.index = compile_rules(self.rules)
+        # the clause mask of each rule when every set has a keyword
+        self.full_masks = {key: (1 << len(rule)) - 1
+                           for key, rule in self.rules.items()}
+        # lookup table of keyword ids (for interned texts)
+        self.is_keyword = None
+        if self.vocab is not None:
+            import numpy as np
+            self.is_keyword = np.zeros(len(self.vocab) + 1, dtype=bool)
+            self.is_keyword[list(self.index)] = True
+
+    def intern(self, vocab):
+        # Converts the keywords of the rules to ids in vocab
+        # (a utils.Vocabulary), adding any that are missing.
+        # Texts must subsequently be sequences of ids encoded
+        # with vocab (e.g. arrays returned by vocab.encode)
+        # and results refer to rule keys as before.
+        # Returns self.
+        self.rules = {key: [set(map(vocab.add, word_set)) for word_set in rule]
+                      for key, rule in self.rules.items()}
+        self.vocab = vocab
+        self.compile()
+        return self
+
+    def subset(self, keys):
+        # Returns a copy of self (without any texts or results)
+        # that only applies the rules with the given keys.
+        analyzer = copy.copy(self)
+        analyzer.__dict__.pop('evaluate', None)
+        analyzer.__dict__.pop('score', None)
+        analyzer.rules = {key: self.rules[key] for key in keys}
+        analyzer.compile()
+        analyzer.texts = analyzer.results = None
+        if 'score' in self.__dict__:
+            analyzer.memoize(self.memo)
+        return analyzer
+
+    def positions(self, text):
+        # Returns the return value of collect_positions for text.
+        if self.is_keyword is not None and not isinstance(text, list):
+            return collect_id_positions(text, self.is_keyword)
+        return collect_positions(text, self.index)
+
+    def score(self, text):
+        # Returns a dict mapping the keys of the rules that
+        # fire for text (a list of words) to their (non-zero)
+        # scores.
+        # Always scores 1, but derived classes
+        # have different scores.
+        positions = self.positions(text)
+        res = {}
+        for key, mask in clause_masks(positions, self.index).items():
+            if mask == self.full_masks[key]:
+                score = self.evaluate(key, positions)
+                if score:
+                    res[key] = score
+        return res
+
+    def evaluate(self, key, positions):
+        # Returns the score of the rule with key for a text,
+        # given the return value of collect_positions for the
+        # text (which must contain a keyword from each set).
+        indices = rule_indices(self.rules[key], positions)
+        if not _ordered_bounds(indices):
+            return 0
+        if key in self.windows:
+            return 1 if _eval_indices_window(indices, self.windows[key]) else 0
+        return 1 if _eval_indices(indices) else 0
+
+    def profile(self, enable=True):
+        # Enable (or disable) recording the number of evaluations,
+        # the number of hits and the evaluation time for each
+        # rule in self.rule_stats (a dict mapping keys to RuleStats).
+        # Statistics are not recorded by worker processes.
+        self.__dict__.pop('evaluate', None)
+        if not enable:
+            return
+        self.rule_stats = defaultdict(RuleStats)
+        evaluate = self.evaluate
+        rule_stats = self.rule_stats
+        def profiled(key, positions):
+            start = time.perf_counter()
+            score = evaluate(key, positions)
+            stats = rule_stats[key]
+            stats.seconds += time.perf_counter() - start
+            stats.evaluations += 1
+            if score:
+                stats.hits += 1
+            return score
+        # shadows the method for this instance only
+        self.evaluate = profiled
+
+    def memoize(self, memo=None, enable=True):
+        # Enable (or disable) reusing the scores of texts that
+        # have already been scored, stored in memo (a ScoreMemo,
+        # which may be shared, or a new ScoreMemo if None) as
+        # self.memo.
+        # Memoisation is not used by worker processes, and a
+        # memoised HybridAnalyzer does not use batch analysis.
+        self.__dict__.pop('score', None)
+        if not enable:
+            self.memo = None
+            return
+        if memo is None:
+            memo = ScoreMemo()
+        self.memo = memo
+        score = self.score
+        # the rules and their hash (recomputed if
+        # the rules are replaced e.g. by intern)
+        fingerprint = [None, None]
+        def memoized(text):
+            if fingerprint[0] is not self.rules:
+                fingerprint[:] = [self.rules, analyzer_hash(self)]
+            key = fingerprint[1], text_hash(text)
+            scores = memo.get(key)
+            if scores is None:
+                scores = score(text)
+                memo.put(key, scores)
+            return dict(scores)
+        # shadows the method for this instance only
+        self.score = memoized
+
+    def analyze(self, texts, workers=None, chunksize=None):
         # list of lists of words
+        # If workers is not None the texts are analyzed in
+        # chunks (of chunksize texts) using a pool
+        # of that many processes.
+        if workers is not None:
+            return self._analyze_parallel(texts, workers, chunksize)
         res = defaultdict(list)
         for i, text in enumerate(texts):
-            for key, rule in self.rules.items():
-                if check_rule(text, rule):
-                    # always appends 1, but
-                    # store anyway as derived
-                    # classes might have different scores
-                    res[key].append((i, 1))
+            for key, score in self.score(text).items():
+                res[key].append((i, score))
         self.texts, self.results = texts, res
 
+    def analyze_iter(self, texts):
+        # "texts" is any iterable of lists of words
+        # (e.g. a generator returned by a Pipeline).
+        # Generates a pair (index, scores) for each text, where
+        # scores is a dict mapping the keys of the rules that fire
+        # to their scores.
+        # Unlike analyze, neither the texts nor the results are
+        # stored, so texts need not fit in memory.
+        for i, text in enumerate(texts):
+            yield i, self.score(text)
+
+    def _worker_copy(self):
+        # Returns a copy of self to send to worker processes
+        # (see _init_worker), without any texts / results
+        # (or profiling or memoisation).
+        analyzer = copy.copy(self)
+        analyzer.texts = analyzer.results = None
+        analyzer.__dict__.pop('evaluate', None)
+        analyzer.__dict__.pop('score', None)
+        analyzer.memo = None
+        return analyzer
+
+    def _analyze_parallel(self, texts, workers, chunksize=None, func=None):
+        # "func" analyzes a chunk in a worker process
+        # (_analyze_chunk if None).
+        if func is None:
+            func = _analyze_chunk
+        if not isinstance(texts, (list, tuple)):
+            texts = list(texts)
+        if chunksize is None:
+            # a few chunks per process to balance the load
+            chunksize = max(1, -(-len(texts) // (4*workers)))
+        chunks = ((i, [_picklable(text) for text in texts[i:i+chunksize]])
+                  for i in range(0, len(texts), chunksize))
+        res = defaultdict(list)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(self._worker_copy(),)) as executor:
+            # chunks are returned in order, so the lists
+            # of (index, score) pairs remain sorted
+            for partial in executor.map(func, chunks):
+                for key, lis in partial.items():
+                    res[key].extend(lis)
+        self.texts, self.results = texts, res
+
+    def coo_arrays(self):
+        # Returns the results as three arrays (rows, cols, data)
+        # in coordinate (COO) format, with text indices as row
+        # indices and indices of sorted rule keys as column indices.
+        # Entries are sorted by column then row.
+        import numpy as np
+        if self.results is None:
+            raise ValueError("No results to output")
+        res = self.results
+        lists = [res.get(key, ()) for key in sorted(self.rules.keys())]
+        counts = np.fromiter((len(lis) for lis in lists), dtype=np.intp, count=len(lists))
+        cols = np.repeat(np.arange(len(lists), dtype=np.int32), counts)
+        pairs = np.fromiter(chain.from_iterable(chain.from_iterable(lists)),
+                            dtype=np.int64, count=2*int(counts.sum()))
+        pairs = pairs.reshape(-1, 2)
+        return pairs[:,0].astype(np.int32), cols, pairs[:,1]
+
     def table_output(self):
         # returns array with rows corresponding
         # to indices of texts and columns corresponding
         # to rule keys (in sorted order)
-        # Returns a sparse matrix (dict mapping coordinates
-        # to non-zero values) with text indicess as row indices
-        # and sorted feature keys as columns
-        if self.results is None:
-            raise ValueError("No results to output")
-        texts, res = self.texts, self.results
-        keys = sorted(self.rules.keys())
-        arr = {}
-        for j, key in enumerate(keys):
-            for i, score in res[key]:
-                arr[(i,j)] = score
-        return arr
+        # Returns a sparse matrix (scipy.sparse.coo_matrix) with
+        # text indices as row indices and sorted feature keys as
+        # columns. If scipy is not installed returns the
+        # equivalent tuple (data, (rows, cols)) of arrays.
+        rows, cols, data = self.coo_arrays()
+        sparse = _sparse()
+        if sparse is None:
+            return data, (rows, cols)
+        shape = (len(self.texts), len(self.rules))
+        return sparse.coo_matrix((data, (rows, cols)), shape=shape)
 
     def data_frame(self, strings=None, suppress=False):
-        if self.results is None:
-            raise ValueError("No results to output")
-        texts, res = self.texts, self.results
+        import numpy as np
+        import pandas as pd
+        sparse = _sparse()
+        rows, cols, data = self.coo_arrays()
+        texts = self.texts
         keys = sorted(self.rules.keys())
-        # create dictionary of sparse arrays with
-        # insertion order equal to order of keys (i.e. sorted)
-        d = {}
-        for key in keys:
-            lis = [0]*len(texts)
-            for i, j in res[key]:
-                lis[i] = j
-            d[key] = pd.arrays.SparseArray(lis, dtype='int32')
-        frame = pd.DataFrame(d, columns=keys)
+        shape = (len(texts), len(keys))
+        data = data.astype('int32')
+        if sparse is not None:
+            matrix = sparse.csc_matrix((data, (rows, cols)), shape=shape)
+            frame = pd.DataFrame.sparse.from_spmatrix(matrix, columns=keys)
+        else:
+            # create dictionary of sparse arrays with
+            # insertion order equal to order of keys (i.e. sorted)
+            bounds = np.searchsorted(cols, np.arange(len(keys) + 1))
+            d = {}
+            for j, key in enumerate(keys):
+                col = np.zeros(len(texts), dtype='int32')
+                col[rows[bounds[j]:bounds[j+1]]] = data[bounds[j]:bounds[j+1]]
+                d[key] = pd.arrays.SparseArray(col, fill_value=0)
+            frame = pd.DataFrame(d, columns=keys)
         if strings:
             if not len(strings) == len(texts):
                 raise ValueError(("'strings' has length {} while "
                                   "analysis is based on {} 'texts'").format(len(strings), len(texts)))
             frame.insert(loc=0, column='Text', value=strings)
         if suppress:
+            # scores are non-zero, so a row / column is
+            # suppressed if it has no entries
+            row_mask = np.bincount(rows, minlength=shape[0]) > 0
+            col_mask = np.bincount(cols, minlength=shape[1]) > 0
             if strings:
-                frame = frame.iloc[[i for i in range(frame.shape[0]) if frame.values[i,1:].sum()],
-                                   [j for j in range(frame.shape[1]) if j==0 or frame.values[:,j].sum()]]
-            else:
-                frame = frame.iloc[[i for i in range(frame.shape[0]) if frame.values[i,:].sum()],
-                                   [j for j in range(frame.shape[1]) if frame.values[:,j].sum()]]
+                col_mask = np.concatenate([[True], col_mask])
+            frame = frame.iloc[row_mask, col_mask]
         return frame
 
 
@@ -281,15 +789,29 @@ class FreqAnalyzer(BoolAnalyzer):
     def __init__(self, rules):
         BoolAnalyzer.__init__(self, rules)
 
-    def analyze(self, texts):
-        # list of lists of words
-        res = defaultdict(list)
-        for i, text in enumerate(texts):
-            for key, rule in self.rules.items():
-                freq = check_freq(text, rule)
+    def score(self, text):
+        positions = self.positions(text)
+        return self.freqs(positions, clause_masks(positions, self.index))
+
+    def freqs(self, positions, masks):
+        # Returns a dict mapping rule keys to (non-zero) frequencies
+        # given the return values of collect_positions and
+        # clause_masks for a text.
+        res = {}
+        for key, mask in masks.items():
+            if mask == self.full_masks[key]:
+                freq = self.evaluate(key, positions)
                 if freq:
-                    res[key].append((i, freq))
-        self.texts, self.results = texts, res
+                    res[key] = freq
+        return res
+
+    def evaluate(self, key, positions):
+        indices = rule_indices(self.rules[key], positions)
+        if not _ordered_bounds(indices):
+            return 0
+        if key in self.windows:
+            return _eval_indices_window(indices, self.windows[key])
+        return _eval_indices2(indices)
 
 
 class HybridAnalyzer(FreqAnalyzer):
@@ -297,19 +819,188 @@ class HybridAnalyzer(FreqAnalyzer):
     def __init__(self, rules):
         FreqAnalyzer.__init__(self, rules)
 
-    def analyze(self, texts):
-        # list of lists of words
-        res = defaultdict(list)
+    def compile(self):
+        FreqAnalyzer.compile(self)
+        self.keys = list(self.rules)
+        # columns for the keywords of the first sets
+        self.keyword_columns = {}
+        for rule in self.rules.values():
+            for word in (rule[0] if rule else ()):
+                self.keyword_columns.setdefault(word, len(self.keyword_columns))
+        # constructed when first needed
+        self.incidence = None
+
+    def score(self, text):
+        positions = self.positions(text)
+        masks = clause_masks(positions, self.index)
+        res = {key: 2*freq for key, freq in self.freqs(positions, masks).items()}
+        for key, mask in masks.items():
+            if key not in res and mask & 1:
+                # the number of occurrences of keywords
+                # from the first set
+                res[key] = sum(len(positions[word])
+                               for word in self.rules[key][0].intersection(positions))
+        return res
+
+    def analyze(self, texts, workers=None, chunksize=None, batch=False):
+        # If batch is True (and scipy is installed) the keyword
+        # scores (used where the frequency is zero) for all texts and
+        # rules are computed by a single sparse matrix product of
+        # the text x keyword counts and the rule x keyword incidence
+        # matrix (rather than rule by rule for each text).
+        # The texts are analyzed in chunks (each batch analyzed) by
+        # worker processes if workers is not None.
+        sparse = _sparse() if batch and 'score' not in self.__dict__ else None
+        if sparse is None:
+            return FreqAnalyzer.analyze(self, texts, workers, chunksize)
+        if workers is not None:
+            return self._analyze_parallel(texts, workers, chunksize, _analyze_batch_chunk)
+        if not isinstance(texts, (list, tuple)):
+            texts = list(texts)
+        self.texts, self.results = texts, self._batch_results(texts, sparse)
+
+    def _batch_results(self, texts, sparse, start=0):
+        # Returns the results (of the kind stored by analyze) for
+        # texts (a list) by batch analysis, with indices from start.
+        import numpy as np
+        if self.incidence is None:
+            rows, cols = [], []
+            for r, rule in enumerate(self.rules.values()):
+                for word in (rule[0] if rule else ()):
+                    rows.append(r)
+                    cols.append(self.keyword_columns[word])
+            self.incidence = sparse.csr_matrix(
+                (np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                shape=(len(self.keys), len(self.keyword_columns)))
+        # a single scan of each text for both the frequencies
+        # and the keyword counts
+        freqs = []
+        rows, cols, data = [], [], []
+        columns = self.keyword_columns
         for i, text in enumerate(texts):
-            for key, rule in self.rules.items():
-                score = 2*check_freq(text, rule)
-                if not score:
-                    cntr = Counter(text)
-                    for keyword in rule[0]:
-                        score += cntr[keyword]
+            positions = self.positions(text)
+            freqs.append(self.freqs(positions, clause_masks(positions, self.index)))
+            for word, lis in positions.items():
+                j = columns.get(word)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+                    data.append(len(lis))
+        counts = sparse.csr_matrix((np.array(data, dtype=np.int64), (rows, cols)),
+                                   shape=(len(texts), len(columns)))
+        scores = (counts @ self.incidence.T).tocsr()
+        res = defaultdict(list)
+        for i, text_freqs in enumerate(freqs):
+            text_scores = {self.keys[j]: int(score) for j, score in
+                           zip(scores.indices[scores.indptr[i]:scores.indptr[i+1]],
+                               scores.data[scores.indptr[i]:scores.indptr[i+1]])}
+            for key, freq in text_freqs.items():
+                text_scores[key] = 2*freq
+            for key, score in text_scores.items():
                 if score:
-                    res[key].append((i, score))
-        self.texts, self.results = texts, res
+                    res[key].append((start + i, score))
+        return res
+
+
+def rule_hash(rule, window=None):
+    # Returns a hash (hex string) of rule (a list of
+    # sets of keywords) and its window (if any)
+    # that does not depend on set order.
+    data = json.dumps([sorted(word_set) for word_set in rule] +
+                      ([] if window is None else [window]))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+def analyzer_hash(analyzer):
+    # Returns a hash (hex string) of the type of analyzer
+    # and its rules.
+    data = json.dumps([type(analyzer).__name__] +
+                      sorted([key, rule_hash(rule, analyzer.windows.get(key))]
+                             for key, rule in analyzer.rules.items()))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+def text_hash(text):
+    # Returns a hash (hex string) of text (a list of words or ids).
+    return hashlib.sha1('\x00'.join(map(str, text)).encode()).hexdigest()
+
+
+class IncrementalAnalysis:
+    # Persists the results of analyzer (e.g. a FreqAnalyzer) in filename
+    # (json), keyed on hashes of the rule definitions and texts, so that
+    # when the rules (or texts) are edited only new or changed rules
+    # are evaluated on all texts, and unchanged rules are only evaluated
+    # on new or changed texts.
+    # The results for unchanged rules and texts are reused.
+    # The stored results are replaced after each analysis, so only
+    # the previous texts and rules are retained.
+    def __init__(self, analyzer, filename):
+        self.analyzer = analyzer
+        self.filename = filename
+
+    def load(self):
+        empty = {'analyzer': type(self.analyzer).__name__, 'texts': [], 'rules': {}}
+        try:
+            with open(self.filename, 'r') as f:
+                store = json.load(f)
+        except FileNotFoundError:
+            return empty
+        if not store.get('analyzer') == empty['analyzer']:
+            # scores from a different kind of analyzer
+            return empty
+        return store
+
+    def save(self, store):
+        tmp = '{}.tmp'.format(self.filename)
+        with open(tmp, 'w') as f:
+            json.dump(store, f)
+        os.replace(tmp, self.filename)
+
+    def analyze(self, texts, workers=None):
+        # As Analyzer.analyze (the results are stored by self.analyzer).
+        # Returns a pair of lists of rule keys, those that were
+        # evaluated on all texts and those that were only
+        # evaluated on new texts.
+        analyzer = self.analyzer
+        if not isinstance(texts, (list, tuple)):
+            texts = list(texts)
+        store = self.load()
+        hashes = [text_hash(text) for text in texts]
+        # indices of the texts with each hash
+        rows = defaultdict(list)
+        for i, h in enumerate(hashes):
+            rows[h].append(i)
+        known = set(store['texts'])
+        new_texts = [i for i, h in enumerate(hashes) if h not in known]
+        rule_hashes = {key: rule_hash(rule, analyzer.windows.get(key))
+                       for key, rule in analyzer.rules.items()}
+        changed = [key for key, h in rule_hashes.items() if h not in store['rules']]
+        unchanged = [key for key, h in rule_hashes.items() if h in store['rules']]
+        # scores (for current texts) keyed on rule hash then text hash
+        scores = {}
+        for key in unchanged:
+            h = rule_hashes[key]
+            scores[h] = {th: score for th, score in store['rules'][h].items()
+                         if th in rows}
+        for keys, indices in [(unchanged, new_texts), (changed, range(len(texts)))]:
+            if not keys or not indices:
+                for key in keys:
+                    scores.setdefault(rule_hashes[key], {})
+                continue
+            sub = analyzer.subset(keys)
+            sub.analyze([texts[i] for i in indices], workers=workers)
+            for key in keys:
+                rule_scores = scores.setdefault(rule_hashes[key], {})
+                for i, score in sub.results.get(key, ()):
+                    rule_scores[hashes[indices[i]]] = score
+        res = defaultdict(list)
+        for key, h in rule_hashes.items():
+            lis = [(i, score) for th, score in scores[h].items() for i in rows[th]]
+            if lis:
+                lis.sort()
+                res[key] = lis
+        self.save({'analyzer': type(analyzer).__name__,
+                   'texts': list(rows), 'rules': scores})
+        analyzer.texts, analyzer.results = texts, res
+        return changed, unchanged
 
 
 def to_latex(frames, filename, landscape=False, **kwargs):
@@ -349,6 +1040,102 @@ def to_latex(frames, filename, landscape=False, **kwargs):
         f.write('\n\n')
         f.write(r'\end{document}')
 
-    
 
+def export(results, filename, keys=None, wide=False, chunksize=2**16, fmt=None):
+    # Writes analysis results to filename in chunks as they are
+    # produced, so memory use is bounded by chunksize.
+    # "results" is an iterable of pairs (text index, scores)
+    # as generated by analyze_iter.
+    # In long format (the default) there is one row
+    # (text_index, rule_key, score) for each non-zero score.
+    # In wide format there is one row for each text, with
+    # text_index followed by a column for each of keys (required,
+    # e.g. sorted(analyzer.rules)); scores for other rule keys
+    # are not written.
+    # "fmt" is 'csv' or 'parquet' (requires pyarrow), inferred
+    # from the extension of filename if None. Each chunk is
+    # written as a Parquet row group.
+    # Returns the number of rows written.
+    if fmt is None:
+        fmt = os.path.splitext(filename)[1][1:].lower()
+    if wide and keys is None:
+        raise ValueError('keys are required for wide format')
+    if wide:
+        keys = list(keys)
+        header = ['text_index'] + keys
+        columns = {key: j for j, key in enumerate(keys, 1)}
+    else:
+        header = ['text_index', 'rule_key', 'score']
+    if fmt == 'csv':
+        writer = _CSVWriter(filename, header)
+    elif fmt == 'parquet':
+        writer = _ParquetWriter(filename, header, wide)
+    else:
+        raise ValueError('unsupported export format {!r}'.format(fmt))
+    n = 0
+    with writer:
+        chunk = []
+        for i, scores in results:
+            if wide:
+                row = [i] + [0]*len(keys)
+                for key, score in scores.items():
+                    j = columns.get(key)
+                    if j is not None:
+                        row[j] = score
+                chunk.append(row)
+            else:
+                chunk.extend([i, key, score] for key, score in sorted(scores.items()))
+            if len(chunk) >= chunksize:
+                writer.write(chunk)
+                n += len(chunk)
+                chunk = []
+        if chunk or not n:
+            writer.write(chunk)
+            n += len(chunk)
+    return n
+
+
+class _CSVWriter:
+    # chunk writer for export
+    def __init__(self, filename, header):
+        import csv
+        self.file = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+class _ParquetWriter:
+    # chunk writer for export (one row group per chunk)
+    def __init__(self, filename, header, wide):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.header = header
+        if wide:
+            types = [pa.int64()]*len(header)
+        else:
+            types = [pa.int64(), pa.string(), pa.int64()]
+        self.schema = pa.schema(list(zip(header, types)))
+        self.writer = pq.ParquetWriter(filename, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows)) if rows else [[]]*len(self.header)
+        table = self.pa.Table.from_arrays(
+            [self.pa.array(col, type=field.type) for col, field in zip(columns, self.schema)],
+            schema=self.schema)
+        self.writer.write_table(table, row_group_size=max(len(rows), 1))
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *args):
+        self.writer.close()
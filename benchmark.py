@@ -0,0 +1,218 @@
+
+##Copyright (c) 2022 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+# Benchmarks for the stages of get_sentence_texts and the analyzers
+# using synthetic corpora (no documents or network access required,
+# but the nltk Punkt data must be installed). Extraction is timed
+# for the synthetic text written to a temporary .txt file.
+# Run as e.g.
+#   python -m RP4.benchmark --sizes 1000 10000 --save baseline.json
+#   python -m RP4.benchmark --sizes 1000 10000 --baseline baseline.json
+# The import time of each module (in a new interpreter) is also
+# measured, so slow imports are reported as regressions.
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import analyze
+from . import extract
+from . import tokenize
+from . import utils
+
+
+SIZES = (1000, 10000, 100000, 1000000)
+
+MODULES = ('analyze', 'extract', 'tokenize', 'utils')
+
+# words that do not appear in any rule
+FILLER = ['the', 'a', 'of', 'to', 'and', 'we', 'you', 'your', 'our',
+          'may', 'will', 'in', 'for', 'with', 'this', 'that', 'by', 'on']
+
+
+def vocabulary():
+    # Returns a list of the words used in the rules
+    # and the normalisation maps, plus filler words.
+    words = set(utils.all_words_from_rules(utils.load_json_data('rules.dat')))
+    for filename in ('synonyms.dat', 'hyponyms.dat'):
+        mapping = utils.load_json_data(filename)
+        words.update(mapping)
+        words.update(mapping.values())
+    return sorted(word.lower() for word in words) + FILLER*10
+
+def synthetic_text(n, seed=0, min_length=5, max_length=25):
+    # Returns a string containing n random sentences
+    # made from the vocabulary.
+    rng = random.Random(seed)
+    words = vocabulary()
+    punctuation = [' ']*8 + [', ', '; ', ' (', ') ']
+    sentences = []
+    for _ in range(n):
+        sentence = ''.join(word + rng.choice(punctuation) for word in
+                           rng.choices(words, k=rng.randint(min_length, max_length)))
+        sentences.append(sentence.strip() + '.')
+    return ' '.join(sentences)
+
+
+def measure(func, arg, memory=True):
+    # Returns the result of func(arg) and a dict containing the
+    # wall time (seconds) and, if memory is True, the peak memory
+    # allocated (bytes) in a separate run under tracemalloc
+    # (which slows execution).
+    start = time.perf_counter()
+    res = func(arg)
+    stats = {'seconds': time.perf_counter() - start}
+    if memory:
+        tracemalloc.start()
+        try:
+            func(arg)
+            stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return res, stats
+
+def run(sizes=SIZES, backend='nltk', memory=True, seed=0, log=None):
+    # Returns a dict mapping each size (as a string, as in json)
+    # to a dict mapping stage names to the stats returned by
+    # measure (plus the throughput in sentences per second).
+    analyzers = [('BoolAnalyzer', analyze.BoolAnalyzer('rules.dat')),
+                 ('FreqAnalyzer', analyze.FreqAnalyzer('rules.dat')),
+                 ('HybridAnalyzer', analyze.HybridAnalyzer('rules.dat'))]
+    normalise = analyze.normalisation_stage()
+    results = {}
+    for n in sizes:
+        stages = {}
+        # the stages of get_sentence_texts
+        # (extraction from a synthetic text file)
+        fd, filename = tempfile.mkstemp(suffix='.txt')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf8') as f:
+                f.write(synthetic_text(n, seed))
+            text, stages['extract'] = measure(
+                lambda x: extract.process(x).decode().lower(), filename, memory)
+        finally:
+            os.remove(filename)
+        sentences, stages['sent_tokenize'] = measure(tokenize.sent_tokenize, text, memory)
+        texts, stages['word_tokenize'] = measure(
+            lambda x: tokenize.tokenize_batch(x, backend), sentences, memory)
+        texts, stages['normalise'] = measure(lambda x: list(normalise(x)), texts, memory)
+        for name, analyzer in analyzers:
+            _, stages[name] = measure(analyzer.analyze, texts, memory)
+        for stats in stages.values():
+            stats['throughput'] = n / stats['seconds'] if stats['seconds'] else None
+        results[str(n)] = stages
+        if log is not None:
+            for name, stats in stages.items():
+                log('{:>8} {:<16} {:10.3f}s {:>12} sentences/s{}'.format(
+                    n, name, stats['seconds'], int(stats['throughput'] or 0),
+                    '  peak {:.1f} MB'.format(stats['peak_bytes']/2**20)
+                    if 'peak_bytes' in stats else ''))
+    return results
+
+def import_time(module, runs=5):
+    # Returns the shortest of runs import times (seconds) of
+    # module (a module of this package, e.g. 'analyze') in
+    # a new interpreter, as reported by -X importtime.
+    package = __name__.rpartition('.')[0]
+    name = '{}.{}'.format(package, module) if package else module
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    times = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + name],
+                              env=env, stderr=subprocess.PIPE, universal_newlines=True,
+                              check=True)
+        # lines are "import time: self [us] | cumulative | imported package"
+        for line in proc.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == name:
+                times.append(int(fields[1]) / 1e6)
+    return min(times)
+
+def run_imports(modules=MODULES, runs=5, log=None):
+    # Returns a dict mapping 'import' to a dict mapping each module
+    # to {'seconds': import time} (for compare).
+    stages = {}
+    for module in modules:
+        stages[module] = {'seconds': import_time(module, runs)}
+        if log is not None:
+            log('{:>8} {:<16} {:10.3f}s'.format('import', module, stages[module]['seconds']))
+    return {'import': stages}
+
+def compare(results, baseline, tolerance=0.25):
+    # Returns a list of strings describing the regressions of results
+    # relative to baseline (both as returned by run) i.e. stages
+    # that are slower, or use more memory, by more than the
+    # proportion tolerance.
+    regressions = []
+    for size, stages in results.items():
+        for name, stats in stages.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+            for measure_name in ('seconds', 'peak_bytes'):
+                if measure_name in stats and base.get(measure_name):
+                    ratio = stats[measure_name] / base[measure_name]
+                    if ratio > 1 + tolerance:
+                        regressions.append('{} {} {}: {:.3g} vs {:.3g} ({:+.0%})'.format(
+                            size, name, measure_name, stats[measure_name],
+                            base[measure_name], ratio - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the text pipeline and analyzers.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='numbers of sentences in the synthetic corpora')
+    parser.add_argument('--backend', default='nltk', help='word tokenizer backend')
+    parser.add_argument('--no-memory', action='store_true', help='skip peak memory measurement')
+    parser.add_argument('--no-imports', action='store_true', help='skip import time measurement')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results (json) to this path')
+    parser.add_argument('--baseline', help='compare with results (json) stored at this path')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed proportional slowdown / memory increase')
+    args = parser.parse_args(argv)
+    results = run(args.sizes, args.backend, not args.no_memory, args.seed, log=print)
+    if not args.no_imports:
+        results.update(run_imports(log=print))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
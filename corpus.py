@@ -0,0 +1,178 @@
+
+##Copyright (c) 2022 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+# On-disk store for tokenized (e.g. normalised) texts that is
+# read via mmap, so texts are not copied into the Python heap.
+#
+# File layout:
+#   header    magic, byte order, number of texts, number of
+#             tokens and offset of the vocabulary (40 bytes)
+#   tokens    word ids of all the texts (int32)
+#   offsets   start of each text in tokens, plus the total (int64,
+#             8 byte aligned)
+#   vocab     the words (json list) indexed by id
+#
+# >>> write_corpus(analyze.iter_sentence_texts('policy.pdf'), 'policy.corpus')
+# >>> with Corpus('policy.corpus') as corpus:
+# ...     analyzer = analyze.FreqAnalyzer('rules.dat').intern(corpus.vocab)
+# ...     analyzer.analyze(corpus)
+
+from array import array
+import json
+import mmap
+import struct
+import sys
+
+from . import utils
+
+
+MAGIC = b'RP4CORP1'
+_HEADER = struct.Struct('<8s8sqqq')
+
+
+def write_corpus(texts, filename, vocab=None):
+    # Writes texts (an iterable of lists of words, e.g. the
+    # generator returned by a Pipeline) to filename.
+    # Texts are written as they are generated.
+    # "vocab" (a utils.Vocabulary) is the initial vocabulary.
+    # Returns the number of texts written.
+    if vocab is None:
+        vocab = utils.Vocabulary()
+    offsets = array('q', [0])
+    with open(filename, 'wb') as f:
+        f.write(b'\0'*_HEADER.size)
+        for text in texts:
+            ids = vocab.encode(text)
+            ids.tofile(f)
+            offsets.append(offsets[-1] + len(ids))
+        # align offsets
+        f.write(b'\0'*(-f.tell() % 8))
+        offsets.tofile(f)
+        vocab_offset = f.tell()
+        f.write(json.dumps(vocab.words).encode('utf8'))
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, sys.byteorder.encode().ljust(8, b'\0'),
+                             len(offsets) - 1, offsets[-1], vocab_offset))
+    return len(offsets) - 1
+
+
+class Corpus:
+    # A read-only, memory-mapped corpus written by write_corpus.
+    # Indexing and iteration give the word ids of texts as
+    # memoryviews of the file (no copying). Analyzers can analyze
+    # these directly after interning with the corpus
+    # vocabulary (see BoolAnalyzer.intern), or use iter_words.
+    # The memoryviews are invalid once the corpus is closed.
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, n_texts, n_tokens, vocab_offset = _HEADER.unpack_from(self._mmap)
+        if not magic == MAGIC:
+            raise ValueError('{} is not a corpus file'.format(filename))
+        if not byteorder.rstrip(b'\0').decode() == sys.byteorder:
+            raise ValueError('{} was written on a machine with a different byte order'.format(filename))
+        view = memoryview(self._mmap)
+        start = _HEADER.size
+        stop = start + 4*n_tokens
+        self.tokens = view[start:stop].cast('i')
+        start = stop + (-stop % 8)
+        self.offsets = view[start:start + 8*(n_texts + 1)].cast('q')
+        self.vocab = utils.Vocabulary(json.loads(self._mmap[vocab_offset:].decode('utf8')))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('corpus index out of range')
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        tokens, offsets = self.tokens, self.offsets
+        for i in range(len(self)):
+            yield tokens[offsets[i]:offsets[i+1]]
+
+    def words(self, i):
+        # Returns text i as a list of words.
+        return self.vocab.decode(self[i])
+
+    def iter_words(self):
+        # Generates the texts as lists of words.
+        decode = self.vocab.decode
+        for ids in self:
+            yield decode(ids)
+
+    def close(self):
+        # release the views before closing the map
+        # If texts (views) are still in use the map is left
+        # to be closed when they have been garbage collected.
+        try:
+            self.tokens.release()
+            self.offsets.release()
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _test_corpus(workers=2):
+    # Checks that the texts of a corpus can be analyzed
+    # directly (serially and in parallel) and that the corpus
+    # can be closed while texts are still referenced.
+    import os
+    import random
+    import tempfile
+    from . import analyze
+    rules = utils.load_json_data('rules.dat')
+    words = sorted(utils.all_words_from_rules(rules)) + ['the', 'a', 'of']*20
+    texts = [random.choices(words, k=random.randint(0, 30)) for _ in range(200)]
+    expected = analyze.FreqAnalyzer(rules)
+    expected.analyze(texts)
+    fd, filename = tempfile.mkstemp(suffix='.corpus')
+    os.close(fd)
+    try:
+        write_corpus(texts, filename)
+        with Corpus(filename) as corpus:
+            for interned in (False, True):
+                analyzer = analyze.FreqAnalyzer(rules)
+                if interned:
+                    analyzer.intern(corpus.vocab)
+                    analyzer.analyze(corpus, workers=workers)
+                else:
+                    analyzer.analyze(corpus.iter_words(), workers=workers)
+                if not analyzer.results == expected.results:
+                    print('Fail (interned)' if interned else 'Fail')
+            analyzer.analyze(corpus)
+            if not analyzer.results == expected.results:
+                print('Fail (serial)')
+    finally:
+        os.remove(filename)
@@ -20,15 +20,23 @@
 ##OTHER DEALINGS IN THE SOFTWARE.
 
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+import hashlib
+import io
+from pathlib import Path
+import subprocess
+import tempfile
 
-import textract
+# textract is slow to import so is imported on first use
+# (as are the parsers, see _parser)
 
 
 EXTENSION_SYNONYMS = {} # mapping of alternative extensions to the ones used here (lower case)
 
 
 def process(filename, input_encoding=None, output_encoding='utf8',
-            extension=None, **kwargs):
+            extension=None, cache=None, **kwargs):
     """Passes arguments directly to textract.process initially. If the file
        extension (e.g. pdf) is not provided it is extracted from
        filename.
@@ -37,7 +45,21 @@ def process(filename, input_encoding=None, output_encoding='utf8',
        https://github.com/deanmalmgren/textract/blob/05fdc7a08dc3fc52eb519aefac4fcbec8981dd8e/docs/index.rst
        If textract does not support the extension, then an appropriate parser is sought in this module.
        If no suitable parser exists (in textract or this module) a NotImplementedError is raised.
+       If an ExtractionCache is supplied as 'cache' the text is only extracted
+       if the file's contents (with the same arguments) have not been extracted before.
     """
+    if cache is not None:
+        key = cache.key(filename, input_encoding=input_encoding,
+                        output_encoding=output_encoding,
+                        extension=extension, **kwargs)
+        txt = cache.get(key)
+        if txt is None:
+            txt = process(filename, input_encoding=input_encoding,
+                          output_encoding=output_encoding,
+                          extension=extension, **kwargs)
+            cache.put(key, txt)
+        return txt
+    import textract
     try:
         txt = textract.process(filename, input_encoding=input_encoding,
                                output_encoding=output_encoding,
@@ -57,34 +79,238 @@ def process(filename, input_encoding=None, output_encoding='utf8',
             ext = EXTENSION_SYNONYMS[ext]
         # look for relevant class or raise NotImplementedError if not found
         try:
-            parser = globals()[ext[1:].capitalize() + 'Parser']()
+            parser = _parser(ext[1:].capitalize() + 'Parser')()
         except KeyError:
             raise NotImplementedError('No available parser for extension {}'.format(extension))
         else:
             txt = parser.process(filename, input_encoding=input_encoding,
                                  output_encoding=output_encoding, **kwargs)
     return txt
-    
-# For convenience (and potentially contributing to textract) parsers can be derived
-# from the following textract classes.
-# Derived classes need only define an 'extract' method taking a filename as argument
-# (and which is also passed **kwargs) that returns a byte-encoded or unicode string.
-# ShellParser is the better option for parsers that need to run external programs
-# See https://github.com/deanmalmgren/textract/tree/master/textract/parsers for details.
-
-from textract.parsers import utils
-
-BaseParser = utils.BaseParser
-ShellParser = utils.ShellParser
-
-# Place parser classes here
-# For extension e.g. '.ext' the corresponding parser should be named 'ExtParser'
-
-class TestParser(BaseParser):
-    def extract(self, filename, **kwargs):
-        # Read file and do whatever is required to
-        # generate the text.
-        # To test just call process with the path to a text
-        # file and supply "extension='.test'".
-        with open(filename, 'r') as f:
-            return f.read()
+
+def iter_pages(filename, input_encoding=None, output_encoding='utf8',
+               extension=None, cache=None, block_size=2**20, **kwargs):
+    """Generates the text of the document as strings, page by page for PDFs
+       (via pdftotext, as textract) and in blocks of 'block_size' characters
+       for text files, so the whole text is never held in memory.
+       Concatenating the strings gives the text (pages are separated by
+       a newline). Other file types (or PDFs if pdftotext is not installed)
+       are extracted by process (which is passed 'cache' and any keyword
+       arguments) and generated as a single string.
+    """
+    ext = extension or os.path.splitext(filename)[1]
+    if not ext.startswith('.'):
+        ext = '.' + ext
+    ext = ext.lower()
+    ext = EXTENSION_SYNONYMS.get(ext, ext)
+    if ext == '.pdf':
+        if cache is not None:
+            key = cache.key(filename, input_encoding=input_encoding,
+                            output_encoding=output_encoding,
+                            extension=extension, **kwargs)
+            f = cache.open(key)
+            if f is not None:
+                with f:
+                    yield from _join_pages(io.TextIOWrapper(f, encoding=output_encoding),
+                                           block_size)
+                return
+        try:
+            proc = subprocess.Popen(['pdftotext', filename, '-'], stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            pass
+        else:
+            with proc:
+                text = io.TextIOWrapper(proc.stdout, encoding='utf8', errors='replace')
+                if cache is None:
+                    yield from _join_pages(text, block_size)
+                else:
+                    # store the text (as process would) as it is read,
+                    # unless pdftotext fails
+                    with cache.writer(key) as f:
+                        yield from _join_pages(text, block_size, f, output_encoding)
+                        if proc.wait():
+                            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+            return
+    elif ext == '.txt':
+        with open(filename, encoding=input_encoding or 'utf8', errors='replace') as f:
+            yield from iter(lambda: f.read(block_size), '')
+        return
+    yield process(filename, input_encoding=input_encoding,
+                  output_encoding=output_encoding, extension=extension,
+                  cache=cache, **kwargs).decode(output_encoding)
+
+def _join_pages(f, block_size, out=None, encoding='utf8'):
+    # Generates the pages of the text read from f (separated
+    # by form feeds, as output by pdftotext) separated by newlines.
+    # The text read is also written (encoded) to out if supplied.
+    tail = ''
+    first = True
+    for block in iter(lambda: f.read(block_size), ''):
+        if out is not None:
+            out.write(block.encode(encoding))
+        pages = (tail + block).split('\f')
+        tail = pages.pop()
+        for page in pages:
+            if not first:
+                yield '\n'
+            yield page
+            first = False
+    if tail:
+        if not first:
+            yield '\n'
+        yield tail
+
+def process_many(filenames, workers=None, cache=None, processes=False,
+                 return_exceptions=False, **kwargs):
+    """Extracts text from each of filenames using a pool of 'workers' threads
+       (or processes if 'processes' is True). Threads are usually sufficient
+       as textract runs external programs for most file types.
+       'cache' and any keyword arguments are passed to process.
+       Generates (filename, bytestring) pairs in the order extraction finishes.
+       If 'return_exceptions' is True a file that cannot be extracted gives
+       (filename, exception) and the remaining files are still extracted,
+       otherwise the exception is raised and pending extractions are cancelled.
+    """
+    kwargs['cache'] = cache
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(process, filename, **kwargs): filename
+                   for filename in filenames}
+        for future in as_completed(futures):
+            try:
+                txt = future.result()
+            except Exception as exc:
+                if not return_exceptions:
+                    raise
+                txt = exc
+            yield futures[future], txt
+    finally:
+        # do not wait for extractions whose results are not wanted
+        # (after an exception or if the generator is closed)
+        executor.shutdown(cancel_futures=True)
+
+
+class ExtractionCache:
+    """On-disk cache of extracted text. Entries are keyed on a hash of
+       the file contents and the extraction arguments, so renamed or copied
+       files are not extracted again and modified files always are.
+       When the total size of the entries exceeds 'max_size' bytes the least
+       recently used entries are removed. The cache may be shared between
+       threads and processes.
+    """
+    def __init__(self, directory, max_size=2**30):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def key(self, filename, **kwargs):
+        # the extension is part of the key as it determines the parser
+        if kwargs.get('extension') is None:
+            kwargs['extension'] = os.path.splitext(filename)[1].lower()
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        h.update(repr(sorted(kwargs.items())).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        # Returns the cached bytestring (or None).
+        path = self.directory / key
+        try:
+            txt = path.read_bytes()
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return txt
+
+    def open(self, key):
+        # Returns the cached entry as a binary file (or None)
+        # so that it can be read incrementally.
+        path = self.directory / key
+        try:
+            f = path.open('rb')
+        except FileNotFoundError:
+            return None
+        # mark as recently used
+        os.utime(path)
+        return f
+
+    def put(self, key, txt):
+        if isinstance(txt, str):
+            txt = txt.encode('utf8')
+        with self.writer(key) as f:
+            f.write(txt)
+
+    @contextmanager
+    def writer(self, key):
+        # Context manager giving a binary file to which the entry
+        # for key can be written incrementally. The entry is only
+        # stored if the block exits without an exception.
+        # A temporary file is written and renamed so that readers
+        # never see a partially written entry.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+        except BaseException:
+            os.remove(tmp)
+            raise
+        os.replace(tmp, self.directory / key)
+        self.evict()
+
+    def evict(self):
+        # Remove least recently used entries until the
+        # total size is no greater than max_size.
+        entries = []
+        for path in self.directory.iterdir():
+            if path.suffix == '.tmp':
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for path in self.directory.iterdir():
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+# Parsers for file types not supported by textract are defined in the
+# parsers module, which is imported when first needed (e.g. by process
+# or on accessing extract.TestParser) as textract is slow to import.
+
+def _parser(name):
+    # Returns the parser class called name, raising KeyError
+    # if there is no such class.
+    from . import parsers
+    try:
+        return getattr(parsers, name)
+    except AttributeError:
+        raise KeyError(name)
+
+def __getattr__(name):
+    # e.g. extract.BaseParser
+    if name.endswith('Parser'):
+        try:
+            return _parser(name)
+        except KeyError:
+            pass
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
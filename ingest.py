@@ -0,0 +1,233 @@
+
+##Copyright (c) 2022 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+# asyncio pipeline for ingesting documents
+# (extraction -> tokenization -> normalisation -> analysis)
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from . import analyze
+from . import extract
+from . import tokenize
+
+
+"""Generic stages and pipeline"""
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+class _Queue(asyncio.Queue):
+    # counts the _DONE sentinels it contains, so
+    # that they are not reported as waiting items
+    def __init__(self, maxsize=0):
+        asyncio.Queue.__init__(self, maxsize)
+        self.sentinels = 0
+
+    def _put(self, item):
+        if item is _DONE:
+            self.sentinels += 1
+        asyncio.Queue._put(self, item)
+
+    def _get(self):
+        item = asyncio.Queue._get(self)
+        if item is _DONE:
+            self.sentinels -= 1
+        return item
+
+    def depth(self):
+        return self.qsize() - self.sentinels
+
+
+class _Failure:
+    # wraps an exception raised by a stage
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class Stage:
+    # A stage of an AsyncPipeline.
+    # "func" is applied to each item by "concurrency" concurrent
+    # workers. Coroutine functions are awaited, other functions
+    # are run in "executor" (the event loop's default thread
+    # pool if None). Use a process pool for CPU bound functions
+    # (which must then be picklable).
+    def __init__(self, func, name=None, concurrency=1, executor=None):
+        self.func = func
+        self.name = name or getattr(func, '__name__', repr(func))
+        self.concurrency = concurrency
+        self.executor = executor
+
+    async def apply(self, item):
+        if asyncio.iscoroutinefunction(self.func):
+            return await self.func(item)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.func, item)
+
+
+class AsyncPipeline:
+    # Runs items through stages connected by bounded queues
+    # (of size maxsize), so a slow stage applies backpressure
+    # to the stages before it and memory use is bounded.
+    # >>> p_line = AsyncPipeline([Stage(f), Stage(g, concurrency=4)])
+    # >>> async for i, result in p_line.run(items): ...
+    def __init__(self, stages, maxsize=16):
+        self.stages = list(stages)
+        self.maxsize = maxsize
+        self.queues = None
+
+    def queue_depths(self):
+        # Returns a dict mapping the name of each stage to the
+        # number of items waiting for that stage ('output' is mapped
+        # to the number of results waiting to be consumed).
+        if self.queues is None:
+            return {}
+        names = [stage.name for stage in self.stages] + ['output']
+        return {name: queue.depth() for name, queue in zip(names, self.queues)}
+
+    async def run(self, items):
+        # "items" is an iterable or asynchronous iterable.
+        # Asynchronously generates pairs (index, result) in the order
+        # in which the results are produced, where index is the
+        # index of the item in items.
+        # An exception raised by a stage is raised here (after
+        # the pipeline has been shut down).
+        queues = self.queues = [_Queue(self.maxsize)
+                                for _ in range(len(self.stages) + 1)]
+        output = queues[-1]
+        tasks = [asyncio.create_task(self._feed(items, queues[0], output))]
+        for stage, inq, outq in zip(self.stages, queues, queues[1:]):
+            # number of workers for the stage still running
+            remaining = [stage.concurrency]
+            for _ in range(stage.concurrency):
+                tasks.append(asyncio.create_task(
+                    self._work(stage, inq, outq, remaining, output)))
+        try:
+            while True:
+                entry = await output.get()
+                if entry is _DONE:
+                    break
+                if isinstance(entry, _Failure):
+                    raise entry.exc
+                yield entry
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def _feed(items, queue, output):
+        try:
+            if hasattr(items, '__aiter__'):
+                i = 0
+                async for item in items:
+                    await queue.put((i, item))
+                    i += 1
+            else:
+                for i, item in enumerate(items):
+                    await queue.put((i, item))
+        except Exception as exc:
+            await output.put(_Failure(exc))
+            return
+        await queue.put(_DONE)
+
+    @staticmethod
+    async def _work(stage, inq, outq, remaining, output):
+        while True:
+            entry = await inq.get()
+            if entry is _DONE:
+                # leave it for the other workers
+                await inq.put(_DONE)
+                remaining[0] -= 1
+                if not remaining[0]:
+                    await outq.put(_DONE)
+                return
+            i, item = entry
+            try:
+                result = await stage.apply(item)
+            except Exception as exc:
+                await output.put(_Failure(exc))
+                return
+            await outq.put((i, result))
+
+
+"""Stages for document ingestion"""
+
+def extract_text(filename, cache=None):
+    # Returns the lower cased text of the document.
+    return extract.process(filename, cache=cache).decode().lower()
+
+def tokenize_sentences(text):
+    return list(tokenize.word_tokenize(tokenize.sent_tokenize(text)))
+
+def tokenize_paragraphs(text):
+    return list(tokenize.word_tokenize(tokenize.paragraph_tokenize(text)))
+
+def normalise(texts):
+    return list(analyze.normalisation_stage()(texts))
+
+def analyze_texts(analyzer, texts):
+    # Returns a list of dicts mapping rule keys
+    # to scores (one dict for each text).
+    return [scores for _, scores in analyzer.analyze_iter(texts)]
+
+def _analyze_worker_texts(texts):
+    # analyze_texts in a worker process of a worker_executor
+    return analyze_texts(analyze._worker_analyzer, texts)
+
+def worker_executor(analyzer, max_workers=None):
+    # Returns a process pool for the CPU bound stages of a
+    # document_pipeline for analyzer. The analyzer is sent
+    # to each process once (rather than with each document).
+    executor = ProcessPoolExecutor(max_workers, initializer=analyze._init_worker,
+                                   initargs=(analyzer._worker_copy(),))
+    executor.analyzer = analyzer
+    return executor
+
+def document_pipeline(analyzer, paragraphs=False, cache=None, maxsize=16,
+                      extract_concurrency=4, tokenize_concurrency=1,
+                      normalise_concurrency=1, analyze_concurrency=1,
+                      cpu_executor=None):
+    # Returns an AsyncPipeline that takes filenames and produces,
+    # for each document, the result of analyze_texts for its
+    # sentence (or paragraph) texts.
+    # Extraction runs external programs, so runs in the default
+    # thread pool. The other stages are CPU bound and run in
+    # cpu_executor if supplied. A process pool must be created
+    # by worker_executor (for analyzer).
+    if isinstance(cpu_executor, ProcessPoolExecutor):
+        if not getattr(cpu_executor, 'analyzer', None) is analyzer:
+            raise ValueError('process pools must be created by worker_executor(analyzer)')
+        analyze_stage = _analyze_worker_texts
+    else:
+        analyze_stage = partial(analyze_texts, analyzer)
+    if paragraphs:
+        tokenize_stage = tokenize_paragraphs
+    else:
+        tokenize_stage = tokenize_sentences
+    return AsyncPipeline([
+        Stage(partial(extract_text, cache=cache), 'extract', extract_concurrency),
+        Stage(tokenize_stage, 'tokenize', tokenize_concurrency, cpu_executor),
+        Stage(normalise, 'normalise', normalise_concurrency, cpu_executor),
+        Stage(analyze_stage, 'analyze', analyze_concurrency, cpu_executor),
+        ], maxsize=maxsize)
@@ -0,0 +1,48 @@
+
+##Copyright (c) 2022 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+# Parsers for file types not supported by textract (see extract.process).
+# This module is imported (by extract) when a parser is first needed,
+# as textract is slow to import.
+#
+# For convenience (and potentially contributing to textract) parsers can be derived
+# from the following textract classes.
+# Derived classes need only define an 'extract' method taking a filename as argument
+# (and which is also passed **kwargs) that returns a byte-encoded or unicode string.
+# ShellParser is the better option for parsers that need to run external programs
+# See https://github.com/deanmalmgren/textract/tree/master/textract/parsers for details.
+
+from textract.parsers import utils
+
+BaseParser = utils.BaseParser
+ShellParser = utils.ShellParser
+
+# Place parser classes here
+# For extension e.g. '.ext' the corresponding parser should be named 'ExtParser'
+
+class TestParser(BaseParser):
+    def extract(self, filename, **kwargs):
+        # Read file and do whatever is required to
+        # generate the text.
+        # To test just call process with the path to a text
+        # file and supply "extension='.test'".
+        with open(filename, 'r') as f:
+            return f.read()
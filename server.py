@@ -0,0 +1,338 @@
+
+##Copyright (c) 2022 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+# Long running local analysis server, which keeps a compiled analyzer,
+# the normalisation maps and the tokenizers loaded between requests.
+# Run as e.g.
+#   python -m RP4.server --analyzer FreqAnalyzer --port 8765
+#   python -m RP4.server --socket /tmp/rp4.sock
+#
+# POST /analyze with a json object containing either
+#   "text"   a string, split into "unit"s ("sentence" (the default),
+#            "paragraph" or "text") which are tokenized and normalised
+#   "texts"  a list of lists of words (already normalised)
+# responds with {"results": [scores, ...]}, a dict mapping rule keys to
+# scores for each unit / text.
+# GET /stats responds with the request latency histogram and batch
+# statistics.
+# Texts from concurrent requests are analyzed together in micro-batches.
+
+import argparse
+from bisect import bisect_left
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+from . import analyze
+from . import tokenize
+
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+           0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float('inf'))
+
+
+class LatencyHistogram:
+    # Thread safe histogram of latencies (seconds).
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # Returns the upper bound of the bucket containing
+        # the q quantile (None if there are no latencies).
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            cum = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cum += count
+                if cum >= rank:
+                    return min(bound, self.max)
+
+    def as_dict(self):
+        res = {'count': self.count,
+               'mean': self.total / self.count if self.count else None,
+               'max': self.max,
+               'p50': self.quantile(0.5),
+               'p90': self.quantile(0.9),
+               'p99': self.quantile(0.99)}
+        with self._lock:
+            res['buckets'] = [['+inf' if bound == float('inf') else bound, count]
+                              for bound, count in zip(self.buckets, self.counts)]
+        return res
+
+
+class Batcher:
+    # Analyzes the texts submitted by (possibly concurrent) callers
+    # in micro-batches in a single thread. A batch is started by the
+    # first waiting submission and includes the texts of further
+    # submissions received within max_delay seconds, up to
+    # max_batch texts.
+    # "kwargs" are passed to analyzer.analyze
+    # (e.g. batch=True for a HybridAnalyzer).
+    def __init__(self, analyzer, max_batch=256, max_delay=0.002, **kwargs):
+        self.analyzer = analyzer
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.kwargs = kwargs
+        self.batches = 0
+        self.texts = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, texts):
+        # Returns a Future for the list of scores (dicts mapping
+        # rule keys to scores) for texts.
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future
+
+    def analyze(self, texts):
+        return self.submit(texts).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            entries = [entry]
+            size = len(entry[0])
+            deadline = time.perf_counter() + self.max_delay
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    # finish this batch first
+                    self._queue.put(None)
+                    break
+                entries.append(entry)
+                size += len(entry[0])
+            self._analyze(entries)
+
+    def _analyze(self, entries):
+        texts = [text for texts, _ in entries for text in texts]
+        try:
+            scores = self._scores(texts)
+        except Exception as exc:
+            if len(entries) == 1:
+                entries[0][1].set_exception(exc)
+                return
+            # analyze each submission alone so that
+            # only those that fail are failed
+            for entry in entries:
+                self._analyze([entry])
+            return
+        self.batches += 1
+        self.texts += len(texts)
+        start = 0
+        for texts, future in entries:
+            future.set_result(scores[start:start + len(texts)])
+            start += len(texts)
+
+    def _scores(self, texts):
+        # Returns the list of scores (dicts) for texts.
+        try:
+            self.analyzer.analyze(texts, **self.kwargs)
+            scores = [{} for _ in texts]
+            for key, lis in self.analyzer.results.items():
+                for i, score in lis:
+                    scores[i][key] = score
+            return scores
+        finally:
+            # do not keep the texts alive
+            self.analyzer.texts = self.analyzer.results = None
+
+
+UNITS = ('sentence', 'paragraph', 'text')
+
+def prepare(text, unit='sentence'):
+    # Returns the normalised texts (lists of words)
+    # for the units of text (a string).
+    if unit == 'sentence':
+        strings = tokenize.sent_tokenize(text.lower())
+    elif unit == 'paragraph':
+        strings = tokenize.paragraph_tokenize(text.lower())
+    elif unit == 'text':
+        strings = [text.lower()]
+    else:
+        raise ValueError('unknown unit {!r}'.format(unit))
+    # the treebank backend reuses the loaded Punkt tokenizer
+    return list(analyze.normalisation_stage()(tokenize.word_tokenize(strings, 'treebank')))
+
+def warm():
+    # Loads the normalisation maps and tokenizers.
+    analyze.normalisation_stage()
+    tokenize.punkt()
+    tokenize.tokenize_batch(['warm up.'], 'treebank')
+
+
+class Handler(BaseHTTPRequestHandler):
+    # server.batcher and server.latency are set by make_server
+
+    def do_GET(self):
+        if self.path == '/stats':
+            batcher = self.server.batcher
+            self._reply(200, {'latency': self.server.latency.as_dict(),
+                              'batches': batcher.batches,
+                              'texts': batcher.texts,
+                              'mean_batch': batcher.texts / batcher.batches if batcher.batches else None})
+        elif self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self.path == '/analyze':
+            self._reply(404, {'error': 'not found'})
+            return
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict):
+                raise ValueError('request must be a json object')
+            if 'texts' in request:
+                texts = request['texts']
+                if not (isinstance(texts, list) and
+                        all(isinstance(text, list) and all(isinstance(word, str) for word in text)
+                            for text in texts)):
+                    raise ValueError("'texts' must be a list of lists of strings")
+            else:
+                text = request['text']
+                unit = request.get('unit', 'sentence')
+                if not isinstance(text, str):
+                    raise ValueError("'text' must be a string")
+                if unit not in UNITS:
+                    raise ValueError("'unit' must be one of {}".format(', '.join(UNITS)))
+                texts = prepare(text, unit)
+        except (ValueError, KeyError, TypeError) as exc:
+            self._reply(400, {'error': str(exc)})
+            return
+        try:
+            results = self.server.batcher.analyze(texts)
+        except Exception as exc:
+            self._reply(500, {'error': str(exc)})
+            return
+        self._reply(200, {'results': results})
+        self.server.latency.add(time.perf_counter() - start)
+
+    def _reply(self, status, obj):
+        body = json.dumps(obj).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client_address is not a (host, port) pair for unix sockets
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPRequestHandler.address_string(self)
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # as HTTPServer.server_bind, without a host name / port
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(analyzer, address=('127.0.0.1', 8765), quiet=True, **kwargs):
+    # Returns a server (call serve_forever) for analyzer.
+    # "address" is a (host, port) pair, or the path of a unix socket.
+    # "kwargs" are passed to Batcher.
+    warm()
+    if isinstance(address, (str, bytes, os.PathLike)):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixHTTPServer(address, Handler)
+    else:
+        server = ThreadingHTTPServer(address, Handler)
+    server.batcher = Batcher(analyzer, **kwargs)
+    server.latency = LatencyHistogram()
+    server.quiet = quiet
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve text analysis over local HTTP.')
+    parser.add_argument('--rules', default='rules.dat', help='rules file')
+    parser.add_argument('--analyzer', default='BoolAnalyzer',
+                        choices=['BoolAnalyzer', 'FreqAnalyzer', 'HybridAnalyzer'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='serve on this unix socket instead')
+    parser.add_argument('--max-batch', type=int, default=256, help='maximum texts per batch')
+    parser.add_argument('--max-delay', type=float, default=0.002,
+                        help='maximum wait (seconds) for texts to add to a batch')
+    parser.add_argument('--verbose', action='store_true', help='log requests')
+    args = parser.parse_args(argv)
+    analyzer = getattr(analyze, args.analyzer)(args.rules)
+    kwargs = {'batch': True} if args.analyzer == 'HybridAnalyzer' else {}
+    address = args.socket or (args.host, args.port)
+    server = make_server(analyzer, address, not args.verbose, max_batch=args.max_batch,
+                         max_delay=args.max_delay, **kwargs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
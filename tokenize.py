@@ -20,7 +20,10 @@
 ##OTHER DEALINGS IN THE SOFTWARE.
 
 
-import nltk
+from functools import lru_cache
+import re
+
+# nltk is imported where it is used as it is slow to import
 
 
 def paragraph_tokenize(text, **kwargs):
@@ -28,7 +31,242 @@ def paragraph_tokenize(text, **kwargs):
     # strings for paragraphs.
     return [s.strip() for s in text.split('\n\n')]
 
-def word_tokenize(string_list, **kwargs):
+def iter_paragraphs(chunks, max_length=2**16):
+    # As paragraph_tokenize for the concatenation of chunks
+    # (an iterable of strings e.g. extract.iter_pages), but
+    # generates the paragraphs as the chunks are read.
+    # Text without a paragraph break is generated as a paragraph
+    # once it exceeds max_length characters.
+    tail = ''
+    for chunk in chunks:
+        pieces = (tail + chunk).split('\n\n')
+        tail = pieces.pop()
+        for piece in pieces:
+            yield piece.strip()
+        if len(tail) > max_length:
+            yield tail.strip()
+            tail = ''
+    yield tail.strip()
+
+@lru_cache(maxsize=None)
+def punkt(language='english'):
+    # Returns the Punkt sentence tokenizer for language,
+    # loaded once and reused.
+    import nltk
+    try:
+        return nltk.tokenize.PunktTokenizer(language)
+    except AttributeError:
+        # older versions of nltk
+        return nltk.data.load('tokenizers/punkt/{}.pickle'.format(language))
+
+@lru_cache(maxsize=None)
+def _treebank():
+    import nltk
+    return nltk.tokenize.NLTKWordTokenizer()
+
+def phrase_words(phrase):
+    # Returns the lists of words phrase (e.g. a key of synonyms.dat)
+    # is tokenized to in lower cased text by word_tokenize: within
+    # a sentence, and at the end of one (if different) where a
+    # final period is split off (and is not part of the phrase)
+    # e.g. "D.P.A." -> [['d.p.a.'], ['d.p.a']],
+    # "gentlemen's agreement" -> [['gentlemen', "'s", 'agreement']].
+    tokenize = _treebank().tokenize
+    phrase = phrase.lower()
+    res = [tokenize(phrase + ' x')[:-1]]
+    words = tokenize(phrase)
+    if len(words) > 1 and words[-1] == '.':
+        words.pop()
+    if not words == res[0]:
+        res.append(words)
+    return res
+
+def sent_tokenize(text, language='english'):
+    # As nltk.sent_tokenize (using the preloaded Punkt tokenizer).
+    return punkt(language).tokenize(text)
+
+def iter_sentences(chunks, language='english', max_length=2**16):
+    # As sent_tokenize for the concatenation of chunks
+    # (an iterable of strings e.g. extract.iter_pages), but
+    # generates the sentences as the chunks are read.
+    # The last two sentences found in the text read so far may
+    # change with the next chunk, so are kept until then
+    # (unless they exceed max_length characters, when they are
+    # generated, so that text without sentence boundaries
+    # is not retokenized with every chunk).
+    tokenizer = punkt(language)
+    tail = ''
+    for chunk in chunks:
+        text = tail + chunk
+        spans = list(tokenizer.span_tokenize(text))
+        if not spans:
+            tail = text
+        else:
+            # whether the second to last boundary is a boundary
+            # depends on the text that follows it, so is decided
+            # again once the next chunk is read
+            for start, end in spans[:-2]:
+                yield text[start:end]
+            tail = text[spans[-2 if len(spans) > 1 else -1][0]:]
+        if len(tail) > max_length:
+            yield from tokenizer.tokenize(tail)
+            tail = ''
+    yield from tokenizer.tokenize(tail)
+
+
+"""Word tokenizer backends"""
+
+# Each backend takes a string (and keyword arguments) and
+# returns a list of words.
+
+def _nltk_tokenize(string, **kwargs):
+    import nltk
+    return nltk.word_tokenize(string, **kwargs)
+
+def _treebank_tokenize(string, language='english', preserve_line=False):
+    # Equivalent to nltk.word_tokenize, but avoids reloading
+    # the sentence tokenizer.
+    if preserve_line:
+        return _treebank().tokenize(string)
+    tokenize = _treebank().tokenize
+    return [word for sentence in sent_tokenize(string, language)
+            for word in tokenize(sentence)]
+
+# characters that are never part of a word
+_PUNCT = r'\s.,;:!?()\[\]{}<>"`$%&@#'
+_TOKEN_RE = re.compile(r"""
+    \d+(?:[.,:]\d+)+                       # numbers e.g. 1,000 3.2 10:30
+  | (?:[^\W\d_]\.){{2,}}(?!\w|\.|[\])}}>"']*\s*$)
+                                          # abbreviations e.g. e.g. u.s.
+                                          # (unless at the end)
+  | \.{{2,}} | -- | ``
+  | [^{0}]+(?:\.[^{0}]+)*                   # words (including internal
+                                          # apostrophes, hyphens, periods)
+    (?:\.(?!\.|[\])}}>"']*\s*$))?        # and a final period (unless
+                                          # at the end, as in nltk)
+  | \S
+""".format(_PUNCT), re.VERBOSE)
+_CONTRACTION_RE = re.compile(r"(?i)(.+?)(n't|'s|'m|'d|'ll|'re|'ve|')$")
+_CLITIC_RE = re.compile(r"(?i)(?:re|ve|ll|m|t|s|d|n)\b")
+_SPLIT_WORDS = {'cannot': ('can', 'not'), 'gimme': ('gim', 'me'),
+                'gonna': ('gon', 'na'), 'gotta': ('got', 'ta'),
+                'lemme': ('lem', 'me'), 'wanna': ('wan', 'na')}
+
+def _regex_tokenize(string):
+    # A fast approximation of nltk.word_tokenize using a single
+    # precompiled regular expression (without sentence splitting).
+    # Gives the same words (and usual punctuation), but differs
+    # e.g. for some abbreviations and unusual quoting.
+    words = []
+    append = words.append
+    for match in _TOKEN_RE.finditer(string):
+        word = match.group()
+        if word == '"':
+            # opening or closing quotes as in nltk
+            start = match.start()
+            if start == 0 or string[start-1] in ' \t\n([{<':
+                append('``')
+            else:
+                append("''")
+        elif "'" in word:
+            if (word[0] == "'" and len(word) > 1 and (word[1].isalnum() or word[1] == '_')
+                    and not _CLITIC_RE.match(word, 1)):
+                # opening quote (not a clitic e.g. 's) as in nltk
+                append("'")
+                word = word[1:]
+            # split suffixes from the end e.g. "can't'" -> ca n't '
+            suffixes = []
+            m = _CONTRACTION_RE.match(word)
+            while m:
+                word = m.group(1)
+                suffixes.append(m.group(2))
+                m = _CONTRACTION_RE.match(word)
+            append(word)
+            words.extend(reversed(suffixes))
+        elif word in _SPLIT_WORDS:
+            words.extend(_SPLIT_WORDS[word])
+        else:
+            append(word)
+    return words
+
+BACKENDS = {'nltk': _nltk_tokenize,
+            'treebank': _treebank_tokenize,
+            'regex': _regex_tokenize}
+
+def register_backend(name, func):
+    # Register func (taking a string and returning
+    # a list of words) as a word tokenizer backend.
+    BACKENDS[name] = func
+
+def word_tokenize(string_list, backend='nltk', **kwargs):
     # Return a generator of lists of words
     # from a list of strings
-    return (nltk.word_tokenize(x, **kwargs) for x in string_list)
+    func = BACKENDS[backend]
+    return (func(x, **kwargs) for x in string_list)
+
+def tokenize_batch(string_list, backend='nltk', **kwargs):
+    # As word_tokenize, but returns a list.
+    return list(word_tokenize(string_list, backend, **kwargs))
+
+def _sample_strings(n=2000, seed=0):
+    # Returns n sentences made from the words of the rules and
+    # normalisation maps (see benchmark.vocabulary) with
+    # punctuation, quotes, contractions and abbreviations.
+    import random
+    from . import benchmark
+    rng = random.Random(seed)
+    words = benchmark.vocabulary() + ["don't", "we'll", "company's", "can't",
+                                      'e.g.', 'i.e.', 'etc.', 'U.K.', '3.5', '$10', '50%']
+    before = [''] * 12 + ['"', '(', "'", '[']
+    after = [''] * 12 + [',', ';', ':', ')', '"', '!', '?', ']', "'"]
+    strings = []
+    for _ in range(n):
+        sentence = ' '.join(rng.choice(before) + word + rng.choice(after)
+                            for word in rng.choices(words, k=rng.randint(3, 25)))
+        strings.append(sentence + rng.choice(['.', '.', '?', '!', '."', '.)']))
+    return strings
+
+def _test_regex_tokenize(strings=None, **kwargs):
+    # Compares the regex backend with nltk for strings
+    # (by default a fixed sample of sentences, see _sample_strings,
+    # tokenized as single lines) and returns a list of
+    # (string, nltk words, regex words) for each string
+    # where they differ.
+    # kwargs are passed to nltk.word_tokenize.
+    if strings is None:
+        strings = _sample_strings()
+        kwargs.setdefault('preserve_line', True)
+    fails = []
+    for string in strings:
+        expected = _nltk_tokenize(string, **kwargs)
+        words = _regex_tokenize(string)
+        if not words == expected:
+            fails.append((string, expected, words))
+    if fails:
+        print ('Fail ({} of {})'.format(len(fails), len(strings)))
+    return fails
+
+def _test_iter_sentences(strings=None, n=1000, seed=0):
+    # Compares iter_sentences for n random chunkings (split at
+    # whitespace and elsewhere) of the concatenation of strings
+    # (by default a fixed sample of sentences, see _sample_strings)
+    # with sent_tokenize for the whole text, and returns a list
+    # of the chunkings (lists of strings) where they differ.
+    import random
+    rng = random.Random(seed)
+    if strings is None:
+        strings = _sample_strings(200, seed)
+    fails = []
+    for _ in range(n):
+        text = ' '.join(rng.sample(strings, rng.randint(1, 10)))
+        if rng.random() < 0.5:
+            cuts = [m.end() for m in re.finditer(r'\s+', text)]
+        else:
+            cuts = list(range(len(text) + 1))
+        cuts = sorted(rng.sample(cuts, min(len(cuts), rng.randint(0, 10))))
+        chunks = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+        if not list(iter_sentences(chunks)) == sent_tokenize(text):
+            fails.append(chunks)
+    if fails:
+        print ('Fail ({} of {})'.format(len(fails), n))
+    return fails
@@ -21,32 +21,74 @@
 
 # various functions / classes that don't obviously belong elsewhere
 
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, product, repeat
 from pathlib import Path
 import json
+import os
+import sys
+import threading
+import time
 
-from nltk.corpus import wordnet as wn
+# nltk.corpus.wordnet is imported where it is used
+# as nltk is slow to import
 
 
 """Find synonyms and hyponyms via WordNet"""
 
+def _name(name):
+    # Converts a synset / lemma name to a word / phrase
+    # e.g. 'data_processing.n.01' -> 'data processing'.
+    # The .split('.')[0] is not necessary for lemma names, but is included
+    # in case the API is changed to make lemme name consistent with
+    # synset names
+    return ' '.join(name.split('.')[0].lower().split('_'))
+
 def synonyms(synset, as_names=True):
     # Returns the synonyms (lemmas) for synset.
     # Returns strings if as_names is True.
     if as_names:
-        # The .split('.')[0] is not necessary below, but is included
-        # in case the API is changed to make lemme name consistent with
-        # synset names
-        return [' '.join(lemma.name().split('.')[0].lower().split('_'))
-                for lemma in synset.lemmas()]
+        return [_name(lemma.name()) for lemma in synset.lemmas()]
     return synset.lemmas()
 
-def hyponyms(synset, as_names=True):
+def hyponyms(synset, as_names=True, depth=1):
     # Returns the hyponyms for synset.
     # Returns strings if as_names is True.
+    # If depth is greater than 1 (or None, for no limit) the
+    # hyponyms of hyponyms etc. are included (breadth first)
+    # to that depth, each only once.
+    found = []
+    seen = {synset}
+    level = [synset]
+    while level and (depth is None or depth > 0):
+        next_level = []
+        for parent in level:
+            for hyponym in parent.hyponyms():
+                if hyponym not in seen:
+                    seen.add(hyponym)
+                    next_level.append(hyponym)
+        found.extend(next_level)
+        level = next_level
+        if depth is not None:
+            depth -= 1
     if as_names:
-        return [' '.join(hyponym.name().split('.')[0].lower().split('_'))
-                for hyponym in synset.hyponyms()]
-    return synset.hyponyms()
+        return [_name(hyponym.name()) for hyponym in found]
+    return found
+
+@lru_cache(maxsize=2**16)
+def first_synset(word):
+    # Returns the first synset for word (or None).
+    # Lookups are cached as WordNet lookups are slow.
+    from nltk.corpus import wordnet as wn
+    synsets = wn.synsets(word)
+    return synsets[0] if synsets else None
+
+def warm_wordnet():
+    # Load WordNet now rather than on first use.
+    from nltk.corpus import wordnet as wn
+    wn.ensure_loaded()
 
 def all_words_from_rules(rules_data):
     # This function is specific to the rules
@@ -60,10 +102,11 @@ def all_words_from_rules(rules_data):
     words = set()
     for key, data in rules_data.items():
         for lis in data[1:]: # we don't want the description
-            words.update(lis)
+            if not isinstance(lis, dict): # or any options
+                words.update(lis)
     return words
 
-def create_syndict(words):
+def create_syndict(words, workers=None):
     # Create mapping of words to synonyms.
     # "words" is an iterable containing strings and / or
     # Synset instances.
@@ -76,43 +119,58 @@ def create_syndict(words):
     # be the correct sense (hence the inclusion of the definition)
     # and the relevant synset will need to be found and
     # substituted for the word in a subsequent function call.
-    syndict = {}
-    for word in set(words):
-        if isinstance(word, str):
-            synsets = wn.synsets(word)
-            if synsets:
-                synset = synsets[0] # try first item
-                syndict[word] = [synset.definition(), synonyms(synset)]
-            else:
-                # word / phrase not in WordNet
-                syndict[word] = ['', [word]]
-        else:
-            # word is a synset
-            synset = word
-            word = ' '.join(synset.name().split('.')[0].lower().split('_'))
-            syndict[word] = [synset.definition(), synonyms(synset)]
-    return syndict
+    # See expand_words for workers.
+    return expand_words(words, 'synonyms', workers=workers)
 
-def create_hypdict(words):
+def create_hypdict(words, depth=1, workers=None):
     # Create mapping of words to hyponyms (derived terms).
+    # Hyponyms are included to the given depth (see hyponyms).
     # Other aspects of this function are identical to
     # those of create_syndict.
-    hypdict = {}
-    for word in set(words):
+    return expand_words(words, 'hyponyms', depth, workers)
+
+def _expand(words, relation, depth=1):
+    # expand_words for strings / synsets in a single process
+    if relation == 'synonyms':
+        related = synonyms
+    elif relation == 'hyponyms':
+        related = lambda synset: hyponyms(synset, depth=depth)
+    else:
+        raise ValueError("relation must be 'synonyms' or 'hyponyms'")
+    res = {}
+    for word in words:
         if isinstance(word, str):
-            synsets = wn.synsets(word)
-            if synsets:
-                synset = synsets[0] # try first item
-                hypdict[word] = [synset.definition(), hyponyms(synset)]
-            else:
+            synset = first_synset(word) # try first item
+            if synset is None:
                 # word / phrase not in WordNet
-                hypdict[word] = ['', [word]]
+                res[word] = ['', [word]]
+                continue
         else:
             # word is a synset
             synset = word
-            word = ' '.join(synset.name().split('.')[0].lower().split('_'))
-            hypdict[word] = [synset.definition(), hyponyms(synset)]
-    return hypdict
+            word = _name(synset.name())
+        res[word] = [synset.definition(), related(synset)]
+    return res
+
+def expand_words(words, relation='synonyms', depth=1, workers=None):
+    # Returns the mapping returned by create_syndict (relation
+    # 'synonyms') or create_hypdict (relation 'hyponyms') for words.
+    # If workers is not None the strings in words are processed in
+    # chunks by a pool of that many processes (each loading
+    # WordNet once), which is worthwhile for large vocabularies.
+    words = set(words)
+    if workers is None:
+        warm_wordnet()
+        return _expand(words, relation, depth)
+    strings = sorted(word for word in words if isinstance(word, str))
+    res = _expand([word for word in words if not isinstance(word, str)],
+                  relation, depth)
+    chunksize = max(1, -(-len(strings) // (4*workers)))
+    chunks = [strings[i:i+chunksize] for i in range(0, len(strings), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_wordnet) as executor:
+        for partial in executor.map(_expand, chunks, repeat(relation), repeat(depth)):
+            res.update(partial)
+    return res
 
 def reverse_map(dic):
     # Create a mapping (dict) of synonyms / hyponyms to words.
@@ -144,7 +202,77 @@ def write_json_data(data, filename):
         filename = Path(__file__).parent / filename
     with open(filename, 'w') as f:
         json.dump(data, f, indent=4, sort_keys=True)
-        
+
+
+"""Process-wide cache of data read from json formatted files"""
+
+# maps resolved paths to ((mtime, size), data)
+_json_cache = {}
+_json_cache_lock = threading.Lock()
+
+def _data_path(filename):
+    # The path read_json_data would read, made absolute
+    # (so it can be used as a cache key).
+    filename = os.fsdecode(filename)
+    if filename == Path(filename).name:
+        filename = Path(__file__).parent / filename
+    return Path(filename).resolve()
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def load_json_data(filename):
+    # As read_json_data, but the data are cached and
+    # shared by all callers, so must not be modified.
+    # The file is only read again if its modification time
+    # or size has changed (or the cache has been invalidated).
+    path = _data_path(filename)
+    stamp = _stamp(path)
+    with _json_cache_lock:
+        entry = _json_cache.get(path)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    data = read_json_data(path)
+    with _json_cache_lock:
+        _json_cache[path] = (stamp, data)
+    return data
+
+def invalidate_cache(filename=None):
+    # Remove the cached data for filename
+    # (or all cached data if filename is None).
+    with _json_cache_lock:
+        if filename is None:
+            _json_cache.clear()
+        else:
+            _json_cache.pop(_data_path(filename), None)
+
+def watch_json_data(filename, callback, interval=1.0):
+    # Polls filename every "interval" seconds (in a daemon thread)
+    # and, whenever the file changes, reloads it into the cache
+    # and calls callback with the new data.
+    # Returns a threading.Event. Set it to stop watching.
+    path = _data_path(filename)
+    stop = threading.Event()
+    def watch():
+        stamp = _stamp(path)
+        while not stop.wait(interval):
+            try:
+                new_stamp = _stamp(path)
+            except OSError:
+                # e.g. file is being replaced
+                continue
+            if new_stamp != stamp:
+                stamp = new_stamp
+                try:
+                    data = load_json_data(path)
+                except ValueError:
+                    # partially written file, wait for next change
+                    stamp = None
+                    continue
+                callback(data)
+    threading.Thread(target=watch, daemon=True).start()
+    return stop
 
 """Utility function for chaining generators"""
 
@@ -165,6 +293,159 @@ class Pipeline(list):
         else:
             return list.__getitem__(self, i)
 
+    def instrument(self, callback=None, logger=None):
+        # Returns an InstrumentedPipeline with the same stages.
+        return InstrumentedPipeline(self, callback, logger)
+
+
+class StageStats:
+    # Statistics for a stage of an InstrumentedPipeline
+    # (accumulated over calls).
+    # Times and block counts exclude those of earlier stages.
+    # "net_blocks" is the net change in the number of allocated
+    # memory blocks (sys.getallocatedblocks), not the number of
+    # allocations: memory allocated and freed within the stage is
+    # not counted, and it is negative if the stage frees more
+    # than it allocates.
+    def __init__(self, name):
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.net_blocks = 0
+
+    def __repr__(self):
+        return ('StageStats({!r}, items_in={}, items_out={}, wall={:.6f}, '
+                'cpu={:.6f}, net_blocks={})').format(
+                    self.name, self.items_in, self.items_out,
+                    self.wall, self.cpu, self.net_blocks)
+
+
+class PipelineStats(list):
+    # A list of StageStats (one per stage)
+    def report(self):
+        # Returns a table (string) of the statistics.
+        lines = ['{:<30} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+            'stage', 'in', 'out', 'wall (s)', 'cpu (s)', 'net blocks')]
+        for stats in self:
+            lines.append('{:<30} {:>10} {:>10} {:>10.4f} {:>10.4f} {:>12}'.format(
+                stats.name[:30], stats.items_in, stats.items_out,
+                stats.wall, stats.cpu, stats.net_blocks))
+        return '\n'.join(lines)
+
+
+def _usage():
+    # wall time, cpu time and allocated blocks
+    return [time.perf_counter(), time.process_time(), sys.getallocatedblocks()]
+
+def _record(stats, start, upstream=None, upstream_start=None):
+    # Adds the usage since start to stats (and returns it),
+    # excluding the usage recorded by upstream (a _Probe) since
+    # upstream_start (its inclusive usage at start).
+    usage = [b - a for a, b in zip(start, _usage())]
+    exclusive = usage
+    if upstream is not None:
+        exclusive = [u - (b - a) for u, a, b in
+                     zip(usage, upstream_start, upstream.inclusive)]
+    stats.wall += exclusive[0]
+    stats.cpu += exclusive[1]
+    stats.net_blocks += exclusive[2]
+    return usage
+
+
+class _Probe:
+    # Wraps the output of a stage of an InstrumentedPipeline,
+    # recording the items generated and the resources used generating
+    # them. The usage recorded in "inclusive" includes that of earlier
+    # stages (i.e. of the upstream probe), which is excluded
+    # from the stage's statistics.
+    def __init__(self, iterable, stats, upstream=None, on_exhausted=None):
+        self.iterator = iter(iterable)
+        self.stats = stats
+        self.upstream = upstream
+        self.on_exhausted = on_exhausted
+        # statistics of the stage consuming the items
+        self.consumer = None
+        self.inclusive = [0.0, 0.0, 0]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = _usage()
+        upstream_start = self.upstream and list(self.upstream.inclusive)
+        try:
+            item = next(self.iterator)
+        except StopIteration:
+            self._add(_record(self.stats, start, self.upstream, upstream_start))
+            if self.on_exhausted is not None:
+                on_exhausted, self.on_exhausted = self.on_exhausted, None
+                on_exhausted()
+            raise
+        self._add(_record(self.stats, start, self.upstream, upstream_start))
+        self.stats.items_out += 1
+        if self.consumer is not None:
+            self.consumer.items_in += 1
+        return item
+
+    def _add(self, usage):
+        self.inclusive = [a + b for a, b in zip(self.inclusive, usage)]
+
+
+class InstrumentedPipeline(Pipeline):
+    # A Pipeline that records statistics for each stage in
+    # self.stats (a PipelineStats instance).
+    # When the output of a call is exhausted, callback (if not None)
+    # is called with self.stats and the statistics are logged (at
+    # level INFO) to logger (if not None).
+    # Each stage's output is wrapped in an iterator, so stages must
+    # accept any iterable.
+    def __init__(self, stages=(), callback=None, logger=None):
+        Pipeline.__init__(self, stages)
+        self.callback = callback
+        self.logger = logger
+        self.reset()
+
+    def reset(self):
+        self.stats = PipelineStats(
+            StageStats('{}: {}'.format(i, getattr(stage, '__qualname__', repr(stage))))
+            for i, stage in enumerate(self))
+
+    def __call__(self, arg):
+        if not len(self.stats) == len(self):
+            # stages have been added / removed
+            self.reset()
+        upstream = None
+        for stage, stats in zip(self, self.stats):
+            if upstream is None:
+                if isinstance(arg, (list, tuple)):
+                    stats.items_in += len(arg)
+                else:
+                    stats.items_in += 1
+            else:
+                upstream.consumer = stats
+            start = _usage()
+            upstream_start = upstream and list(upstream.inclusive)
+            arg = stage(arg)
+            _record(stats, start, upstream, upstream_start)
+            arg = upstream = _Probe(arg, stats, upstream)
+        if upstream is not None:
+            upstream.on_exhausted = self._finished
+        return arg
+
+    def _finished(self):
+        if self.callback is not None:
+            self.callback(self.stats)
+        if self.logger is not None:
+            self.logger.info('Pipeline statistics\n%s', self.stats.report())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Pipeline(list.__getitem__(self, i))
+        else:
+            return list.__getitem__(self, i)
+
 
 """Function for replacing words according to supplied mapping"""
 
@@ -176,15 +457,262 @@ def find_replace(words, mapping):
     return [mapping.get(word, word) for word in words]
 
 
+def resolve_map(mapping):
+    # Returns a mapping (dict) in which each key of "mapping" is
+    # mapped to the end of its chain of replacements
+    # e.g. {'a': 'b', 'b': 'c'} -> {'a': 'c', 'b': 'c'}.
+    # A chain ends at a fixed point (a word that is mapped
+    # to itself) or at a word that is not a key.
+    # A ValueError is raised if a chain is cyclic.
+    res = {}
+    for key in mapping:
+        chain = []
+        word = key
+        while word not in res:
+            replacement = mapping.get(word, word)
+            if replacement == word:
+                # fixed point
+                res[word] = word
+                break
+            if word in chain:
+                raise ValueError('Cyclic replacements: {}'.format(
+                    ' -> '.join(chain[chain.index(word):] + [word])))
+            chain.append(word)
+            word = replacement
+        # every word in the chain is replaced by the end of the chain
+        for link in chain:
+            res[link] = res[word]
+    return {key: res[key] for key in mapping}
+
+def compose_maps(*mappings, resolve=False, strict=False):
+    # Returns a single mapping (dict) s.t. one replacement stage
+    # using it is equivalent to a replacement stage for each
+    # of "mappings" in turn (e.g. synonyms then hyponyms).
+    # Keys of all the mappings are retained (including those
+    # mapped to themselves, as they might be phrases).
+    # If resolve is True chains within each mapping are first
+    # followed to their fixed points (see resolve_map).
+    # If strict is True a ValueError is raised for conflicting
+    # mappings i.e. where a key of a later mapping has already
+    # been replaced by a word that the later mapping
+    # maps differently (so its entry for the key is never used).
+    res = {}
+    for mapping in mappings:
+        if resolve:
+            mapping = resolve_map(mapping)
+        composed = {key: mapping.get(val, val) for key, val in res.items()}
+        conflicts = []
+        for key, val in mapping.items():
+            if key not in composed:
+                composed[key] = val
+            elif composed[key] != val:
+                conflicts.append('{!r} -> {!r} (not {!r})'.format(key, composed[key], val))
+        if strict and conflicts:
+            raise ValueError('Conflicting replacements: {}'.format(', '.join(conflicts)))
+        res = composed
+    return res
+
+def phrase_trie(mapping, split=str.split):
+    # Returns a trie (nested dicts keyed by words) built
+    # from "mapping", a dict mapping words / phrases to
+    # the words that will replace them.
+    # Phrases are split into words with "split", which should
+    # split phrases in the same way the texts were tokenized.
+    # The replacement for a phrase is stored under the key None
+    # in the node reached by the last word of the phrase.
+    trie = {}
+    for phrase, replacement in mapping.items():
+        node = trie
+        for word in split(phrase):
+            node = node.setdefault(word, {})
+        node[None] = replacement
+    return trie
+
+def phrase_keys(mapping, split=None):
+    # Returns a dict mapping the tuples of words that the keys
+    # (words / phrases) of "mapping" are tokenized to in texts
+    # to their replacements.
+    # "split" takes a key and returns a list of lists of words,
+    # by default tokenize.phrase_words (for texts that are lower
+    # cased and tokenized by tokenize.word_tokenize).
+    if split is None:
+        from . import tokenize
+        split = tokenize.phrase_words
+    return {tuple(words): replacement for phrase, replacement in mapping.items()
+            for words in split(phrase)}
+
+def fuse_phrase_maps(*mappings, split=None):
+    # Returns a dict mapping tuples of words to their replacements
+    # (see phrase_keys) s.t. one phrase replacement stage using it
+    # is equivalent to a stage for each of "mappings" in turn
+    # (e.g. synonyms then hyponyms).
+    # The replacements of each mapping are replaced according to
+    # the later mappings (as compose_maps) and the phrases of a
+    # later mapping are added for each sequence of words that the
+    # earlier mappings replace by its words (e.g. if 'yr' -> 'year'
+    # the phrase 'calendar year' is added as ('calendar', 'yr')).
+    # Where a phrase of an earlier mapping overlaps the start or end
+    # of a phrase of a later one, the longest match in the original
+    # words is replaced (which may differ from matching in turn).
+    # "split" is passed to phrase_keys.
+    fused = {}
+    for mapping in mappings:
+        # the sequences of words replaced by each word
+        preimages = {}
+        for words, replacement in fused.items():
+            preimages.setdefault(replacement, []).append(words)
+        res = {}
+        for words, replacement in phrase_keys(mapping, split).items():
+            options = [preimages.get(word, []) + ([] if (word,) in fused else [(word,)])
+                       for word in words]
+            for sequences in product(*options):
+                res[tuple(chain.from_iterable(sequences))] = replacement
+        # earlier phrases are matched first
+        for words, replacement in fused.items():
+            res[words] = mapping.get(replacement, replacement)
+        fused = res
+    return fused
+
+def find_replace_phrases(words, trie):
+    # "words" is a list of strings.
+    # "trie" is a trie as returned by phrase_trie.
+    # Scanning from the left, the longest phrase starting at
+    # each word is replaced by a single word (its replacement).
+    # Words that do not start a phrase are retained.
+    # Linear in the number of words (for phrases of
+    # bounded length).
+    res = []
+    i, n = 0, len(words)
+    while i < n:
+        node = trie
+        match = None
+        j = i
+        while j < n:
+            try:
+                node = node[words[j]]
+            except KeyError:
+                break
+            j += 1
+            if None in node:
+                match = j, node[None]
+        if match is None:
+            res.append(words[i])
+            i += 1
+        else:
+            i, replacement = match
+            res.append(replacement)
+    return res
+
+
+"""Interned (integer) representation of words"""
+
+class Vocabulary:
+    # Maps words to integer ids (0, 1, 2, ... in order of addition)
+    # so that texts can be stored compactly as arrays of ids
+    # e.g. array('i', [3, 0, 7]) rather than lists of strings.
+    def __init__(self, words=()):
+        self.ids = {}
+        self.words = []
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def add(self, word):
+        # Returns the id of word (adding it if necessary).
+        try:
+            return self.ids[word]
+        except KeyError:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+            return i
+
+    def encode(self, words):
+        # Returns an array('i') of the ids of words
+        # (adding any new words).
+        ids = self.ids
+        add = self.add
+        return array('i', [ids[word] if word in ids else add(word) for word in words])
+
+    def decode(self, ids):
+        # Returns the list of words for ids.
+        words = self.words
+        return [words[i] for i in ids]
+
+    def encode_map(self, *mappings, split=None):
+        # Returns the trie that phrase_replacement_factory uses for
+        # "mappings" (with keys lower cased and tokenized, see
+        # fuse_phrase_maps) with words and replacements as ids, for
+        # replacing words and phrases in interned texts in the same way.
+        return self.encode_trie(phrase_trie(fuse_phrase_maps(*mappings, split=split),
+                                            split=list))
+
+    def encode_trie(self, trie):
+        # Returns trie (see phrase_trie) with words
+        # and replacements as ids.
+        add = self.add
+        return {None if word is None else add(word):
+                add(node) if word is None else self.encode_trie(node)
+                for word, node in trie.items()}
+
+
+def intern_factory(vocab):
+    # returns a function that takes an iterable of word lists
+    # and generates arrays of word ids (see Vocabulary.encode)
+    def f(word_lists):
+        return (vocab.encode(word_list) for word_list in word_lists)
+    return f
+
+
+def find_replace_ids(ids, trie):
+    # As find_replace_phrases for an array of word ids
+    # (with a trie returned by Vocabulary.encode_map).
+    return array('i', find_replace_phrases(ids, trie))
+
+
 """Convenience / factory functions for constructing pipelines"""
 
-def replacement_factory(mapping):
+def replacement_factory(mapping, phrases=False):
     # returns a function that takes an iterable of word lists
     # and generates word lists with words replaced according to mapping
+    # If phrases is True multi-word keys in mapping are matched
+    # (longest first) against consecutive words and each
+    # match is replaced by a single word.
+    # For phrase matching keys are lower cased and tokenized as
+    # texts are (see phrase_keys) e.g. 'Data Protection Act'
+    # matches ['data', 'protection', 'act'].
+    # Replacements are retained as they are.
+    if phrases:
+        return phrase_replacement_factory(mapping)
     def f(word_lists):
         return (find_replace(word_list, mapping) for word_list in word_lists)
     return f
 
+def phrase_replacement_factory(*mappings, split=None):
+    # As replacement_factory with phrases=True for each of
+    # mappings in turn (e.g. synonyms then hyponyms), but as
+    # a single stage with one trie (see fuse_phrase_maps), so
+    # there is one lookup per word and one new list per text.
+    # "split" is passed to phrase_keys.
+    trie = phrase_trie(fuse_phrase_maps(*mappings, split=split), split=list)
+    def f(word_lists):
+        for word_list in word_lists:
+            if not isinstance(word_list, (list, tuple)):
+                word_list = list(word_list)
+            yield find_replace_phrases(word_list, trie)
+    return f
+
+def id_replacement_factory(trie):
+    # As phrase_replacement_factory for arrays of word ids
+    # (with a trie returned by Vocabulary.encode_map).
+    def f(id_arrays):
+        return (find_replace_ids(ids, trie) for ids in id_arrays)
+    return f
+
 def filter_factory(func):
     # returns a function that takes an iterable of word lists
     # and generates word lists with words filtered according